@@ -1,4 +1,5 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import pandas as pd
 import os
@@ -7,11 +8,23 @@ import json
 import numpy as np
 import io
 import time
+import datetime
+import hashlib
+import base64
+import threading
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import shutil
 import requests
+import httpx
 import gspread
 from google.oauth2.service_account import Credentials
 from pydantic import BaseModel
 from typing import Optional, Union
+from dataclasses import dataclass, field
+from collections import OrderedDict
 
 app = FastAPI()
 
@@ -31,299 +44,961 @@ EXCEL_URL = os.environ.get(
 )
 UNALLOCATED_GSHEET_URL = "https://docs.google.com/spreadsheets/d/1Ni-HNW28V8V2vHt__YPPiiBeTX333vDQf_9Qw96wdmc/export?format=xlsx"
 MOVEMENT_GSHEET_URL = "https://docs.google.com/spreadsheets/d/1_GxpusG5YZYkmqZ-DMyoRZqO4ak_6XWofqUQx2RY89s/export?format=csv"
+MOVEMENT_XLSX_URL = MOVEMENT_GSHEET_URL.replace("format=csv", "format=xlsx")
+
+# EXPLICAÇÃO: Todas as planilhas passam por esta camada. Cada uma é baixada no máximo uma vez
+# por janela de TTL, mesmo com várias requisições simultâneas (single-flight), e o hash do
+# conteúdo permite reaproveitar o arquivo já aberto quando a exportação não mudou.
+WORKBOOK_SOURCES = {
+    "main": EXCEL_URL,
+    "unallocated": UNALLOCATED_GSHEET_URL,
+    "movement": MOVEMENT_XLSX_URL,
+}
+SHEETS_CACHE_TTL = float(os.environ.get("SHEETS_CACHE_TTL", "30"))
+SHEETS_DOWNLOAD_TIMEOUT = float(os.environ.get("SHEETS_DOWNLOAD_TIMEOUT", "30"))
+
+def _resolve_xlsx_engine(name):
+    """'calamine' (leitor em Rust, bem mais rápido) quando disponível, senão o openpyxl padrão do pandas."""
+    name = name.lower().strip()
+    if name in ("auto", "calamine"):
+        try:
+            import python_calamine  # noqa: F401
+            return "calamine"
+        except ImportError:
+            if name == "calamine":
+                print("DEBUG: XLSX_ENGINE=calamine, mas python-calamine não está instalado. Usando openpyxl.")
+    return "openpyxl"
+
+# EXPLICAÇÃO: XLSX_ENGINE=auto|calamine|openpyxl escolhe o leitor usado em todas as planilhas
+XLSX_ENGINE = _resolve_xlsx_engine(os.environ.get("XLSX_ENGINE", "auto"))
+
+try:
+    # Serializador JSON em Rust, usado nas respostas grandes que ficam prontas no snapshot
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_default(value):
+    """Valores que nenhum dos dois serializadores conhece: datas das planilhas e escalares do numpy."""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value.item() if hasattr(value, "item") else str(value)
+
+def dumps_json(obj):
+    """Corpo JSON em bytes: orjson quando instalado, senão o json da biblioteca padrão."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+class Workbook:
+    """Planilha baixada, identificada pelo hash do conteúdo."""
+
+    def __init__(self, name, content):
+        self.name = name
+        self.content = content
+        self.hash = hashlib.sha1(content).hexdigest()
+        self.checked_at = time.time()
+        self._xl = None
+        # Abas já processadas nesta versão do conteúdo: (hash, aba) -> DataFrame
+        self._sheets = {}
+        self._sheet_info = None
+        self._derived = {}
+        self._lock = threading.RLock()
+
+    @property
+    def xl(self):
+        if self._xl is None:
+            self._xl = pd.ExcelFile(io.BytesIO(self.content), engine=XLSX_ENGINE)
+        return self._xl
+
+    @property
+    def sheet_names(self):
+        return self.xl.sheet_names
+
+    def parse(self, sheet_name=0, **kwargs):
+        """Lê uma aba. A leitura completa é feita uma única vez por versão e depois copiada."""
+        if kwargs:
+            return self.xl.parse(sheet_name, **kwargs)
+        if isinstance(sheet_name, int):
+            sheet_name = self.sheet_names[sheet_name]
+
+        key = (self.hash, sheet_name)
+        with self._lock:
+            if key not in self._sheets:
+                self._sheets[key] = self.xl.parse(sheet_name)
+            # Cópia para que quem chama possa renomear/alterar colunas sem afetar o cache
+            return self._sheets[key].copy()
+
+    def has_sheet(self, sheet_name):
+        return (self.hash, sheet_name) in self._sheets
+
+    def store_sheet(self, sheet_name, df):
+        """Guarda uma aba lida fora daqui (ex.: em outro processo) como se tivesse sido lida pelo parse."""
+        with self._lock:
+            self._sheets.setdefault((self.hash, sheet_name), df)
+
+    def derived(self, key, builder):
+        """Resultado calculado a partir desta versão do conteúdo, calculado uma única vez."""
+        with self._lock:
+            if key not in self._derived:
+                self._derived[key] = builder(self)
+            return self._derived[key]
+
+    def sheet_info(self):
+        """{aba: (linhas, cabeçalho)} lido dos metadados da planilha, sem processar as abas."""
+        with self._lock:
+            if self._sheet_info is None:
+                info = {}
+                for s in self.sheet_names:
+                    header, n_rows = self._sheet_dimensions(s)
+                    if n_rows is None:
+                        # Aba sem dimensão gravada: conta as linhas lendo a aba (fica em cache)
+                        key = (self.hash, s)
+                        if key not in self._sheets:
+                            self._sheets[key] = self.xl.parse(s)
+                        n_rows = len(self._sheets[key])
+                    info[s] = (n_rows, [c for c in header if c is not None and c != ''])
+                self._sheet_info = info
+            return self._sheet_info
+
+    def _sheet_dimensions(self, sheet_name):
+        """(cabeçalho, linhas de dados) direto do leitor; linhas é None se a aba não informar."""
+        book = self.xl.book
+        if XLSX_ENGINE == "calamine":
+            sheet = book.get_sheet_by_name(sheet_name)
+            header = sheet.to_python(nrows=1)[0] if sheet.height else []
+            return header, max(sheet.height - 1, 0)
+        ws = book[sheet_name]
+        header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+        return header, (ws.max_row - 1) if ws.max_row else None
+
+_workbooks = {}
+_workbook_locks = {name: threading.Lock() for name in WORKBOOK_SOURCES}
+
+def get_workbook(name, max_age=None):
+    """Retorna a planilha `name` ('main', 'unallocated' ou 'movement'), baixando se o cache expirou."""
+    ttl = SHEETS_CACHE_TTL if max_age is None else max_age
+    wb = _workbooks.get(name)
+    if wb is not None and time.time() - wb.checked_at < ttl:
+        return wb
+
+    with _workbook_locks[name]:
+        # Outra requisição pode ter concluído o download enquanto esperávamos o lock
+        wb = _workbooks.get(name)
+        if wb is not None and time.time() - wb.checked_at < ttl:
+            return wb
+
+        url = WORKBOOK_SOURCES[name]
+        print(f"DEBUG: Baixando planilha '{name}' de {url}")
+        try:
+            response = requests.get(url, timeout=SHEETS_DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+        except Exception as e:
+            if wb is None:
+                raise
+            print(f"DEBUG: Falha ao baixar '{name}' ({e}). Usando versão em cache.")
+            return wb
+
+        return _accept_download(name, response.content)
+
+def _accept_download(name, content):
+    """Guarda o conteúdo baixado de `name`, mantendo o Workbook atual se a exportação for idêntica."""
+    wb = _workbooks.get(name)
+    if wb is not None and wb.hash == hashlib.sha1(content).hexdigest():
+        # Exportação idêntica: mantém o arquivo já aberto
+        wb.checked_at = time.time()
+        return wb
+
+    wb = Workbook(name, content)
+    _workbooks[name] = wb
+    return wb
+
+# EXPLICAÇÃO: nos endpoints as planilhas são baixadas com um cliente httpx assíncrono (pool de
+# conexões, as três em paralelo) e o processamento pesado (pandas/openpyxl) roda em um pool de
+# WORK_THREADS threads. Assim um download lento do Google não trava o event loop, nem o "/".
+WORK_THREADS = int(os.environ.get("WORK_THREADS", "4"))
+_executor = ThreadPoolExecutor(max_workers=WORK_THREADS, thread_name_prefix="snapshot")
+_http_clients = {}
+_workbook_async_locks = {}
+
+async def run_blocking(fn, *args):
+    """Roda `fn(*args)` no pool de processamento sem bloquear o event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args))
+
+def _http_client():
+    """Cliente HTTP (com pool de conexões) do event loop atual."""
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(timeout=SHEETS_DOWNLOAD_TIMEOUT, follow_redirects=True)
+        _http_clients[loop] = client
+    return client
+
+async def fetch_workbook(name, max_age=None):
+    """Versão assíncrona do get_workbook: mesmo cache e mesma regra de usar a cópia velha se falhar."""
+    ttl = SHEETS_CACHE_TTL if max_age is None else max_age
+    wb = _workbooks.get(name)
+    if wb is not None and time.time() - wb.checked_at < ttl:
+        return wb
+
+    lock = _workbook_async_locks.setdefault((asyncio.get_running_loop(), name), asyncio.Lock())
+    async with lock:
+        wb = _workbooks.get(name)
+        if wb is not None and time.time() - wb.checked_at < ttl:
+            return wb
+
+        url = WORKBOOK_SOURCES[name]
+        print(f"DEBUG: Baixando planilha '{name}' de {url}")
+        try:
+            response = await _http_client().get(url)
+            response.raise_for_status()
+        except Exception as e:
+            if wb is None:
+                raise
+            print(f"DEBUG: Falha ao baixar '{name}' ({e}). Usando versão em cache.")
+            return wb
+
+        return _accept_download(name, response.content)
+
+# EXPLICAÇÃO: com PARSE_PROCESSES > 0, quando as planilhas mudam as abas que o snapshot usa são lidas
+# em paralelo em processos separados e entram no cache de cada Workbook; o get_clean_data e a
+# ingestão da movimentação então só encontram abas já lidas. 0 (padrão) mantém a leitura sob demanda.
+PARSE_PROCESSES = int(os.environ.get("PARSE_PROCESSES", "0"))
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def _parse_sheet_worker(content, sheet_name):
+    """Roda no processo filho: lê uma aba do conteúdo XLSX."""
+    return pd.read_excel(io.BytesIO(content), sheet_name=sheet_name, engine=XLSX_ENGINE)
+
+def _get_parse_pool():
+    global _parse_pool
+    if PARSE_PROCESSES <= 0:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn: o processo pai tem threads (event loop, pool de processamento), então nada de fork
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+def snapshot_sheets(name, wb):
+    """Abas da planilha `name` que o processamento do snapshot lê; as demais (ex.: 'Soma') nunca são lidas."""
+    if name == "main":
+        wanted = ['Base de dados', 'Posições Cadastradas', 'Inf dos produtos']
+    elif name == "unallocated":
+        wanted = wb.sheet_names[:1]
+    else:
+        wanted = [find_movement_sheet(wb), find_quantity_sheet(wb), 'A501', 'G501']
+    return [s for s in dict.fromkeys(wanted) if s in wb.sheet_names]
+
+def parse_workbooks_parallel(workbooks):
+    """Lê em paralelo as abas do snapshot ainda não lidas. Abas que falharem ficam para o parse normal."""
+    pool = _get_parse_pool()
+    if pool is None:
+        return
+    start = time.perf_counter()
+    jobs = {}
+    for name, wb in workbooks.items():
+        for sheet in snapshot_sheets(name, wb):
+            if not wb.has_sheet(sheet):
+                jobs[pool.submit(_parse_sheet_worker, wb.content, sheet)] = (wb, sheet)
+    for future, (wb, sheet) in jobs.items():
+        try:
+            wb.store_sheet(sheet, future.result())
+        except Exception as e:
+            print(f"DEBUG PARSE: Falha ao ler '{sheet}' de '{wb.name}' em paralelo ({e}).")
+    print(f"DEBUG PARSE: {len(jobs)} abas lidas em {PARSE_PROCESSES} processos em {time.perf_counter() - start:.2f}s")
+
+async def fetch_workbooks(max_age=None):
+    """As três planilhas, baixadas em paralelo."""
+    names = list(WORKBOOK_SOURCES)
+    return dict(zip(names, await asyncio.gather(*(fetch_workbook(n, max_age) for n in names))))
+
+class SchemaResolution:
+    """Resultado do mapeamento de um conjunto de cabeçalhos."""
+
+    def __init__(self, mapping, unmapped, ambiguous):
+        self.mapping = mapping        # cabeçalho original -> coluna padrão
+        self.unmapped = unmapped      # cabeçalhos que nenhuma regra reconheceu
+        self.ambiguous = ambiguous    # coluna padrão -> cabeçalhos que disputaram por ela
+
+    def column_for(self, target):
+        """Primeiro cabeçalho mapeado para `target` (ou None)."""
+        return next((h for h, t in self.mapping.items() if t == target), None)
+
+    def as_dict(self):
+        return {
+            "mapping": {str(h): t for h, t in self.mapping.items()},
+            "unmapped": [str(h) for h in self.unmapped],
+            "ambiguous": {t: [str(h) for h in hs] for t, hs in self.ambiguous.items()},
+        }
+
+class HeaderSchema:
+    """Regras de reconhecimento de cabeçalhos de uma aba, compiladas uma única vez.
+
+    Cada regra é (coluna padrão, alternativas). Uma alternativa é um texto procurado no cabeçalho
+    em minúsculas; "a+b" exige os dois trechos, "!x" proíbe o trecho e "=x" exige o cabeçalho exato.
+
+    - mode="header": cada cabeçalho recebe a primeira regra que casa (como uma cadeia de if/elif).
+      Com first_only=True só o cabeçalho de melhor prioridade fica com cada coluna padrão.
+    - mode="target": cada regra procura, alternativa por alternativa, o primeiro cabeçalho que casa.
+
+    O mapeamento é guardado por assinatura de cabeçalhos, então só é recalculado quando a planilha
+    muda de formato. Cabeçalhos não reconhecidos e colunas disputadas da última leitura da aba ficam
+    em `last_resolution` (o que o /api/schema mostra); as rotas de escrita usam record=False.
+    """
+    registry = {}
+
+    def __init__(self, name, rules, mode="header", first_only=False):
+        self.name = name
+        self.mode = mode
+        self.first_only = first_only
+        self.rules = [(target, [self._compile(alt) for alt in alternatives]) for target, alternatives in rules]
+        self._cache = {}
+        self.last_resolution = None
+        HeaderSchema.registry[name] = self
+
+    @staticmethod
+    def _compile(alternative):
+        if alternative.startswith('='):
+            return (alternative[1:].lower(),), (), True
+        parts = alternative.lower().split('+')
+        required = tuple(p for p in parts if not p.startswith('!'))
+        forbidden = tuple(p[1:] for p in parts if p.startswith('!'))
+        return required, forbidden, False
+
+    @staticmethod
+    def _matches(header, alternative):
+        required, forbidden, exact = alternative
+        if exact:
+            return header == required[0]
+        return all(p in header for p in required) and not any(p in header for p in forbidden)
+
+    def resolve(self, headers, record=True):
+        headers = list(headers)
+        signature = tuple(str(h) for h in headers)
+        cached = self._cache.get(signature)
+        if cached is None:
+            cached = self._resolve(headers)
+            self._cache[signature] = cached
+            if cached.unmapped or cached.ambiguous:
+                print(f"DEBUG SCHEMA '{self.name}': não mapeados={[str(h) for h in cached.unmapped]} "
+                      f"ambíguos={ {t: [str(h) for h in hs] for t, hs in cached.ambiguous.items()} }")
+        if record:
+            self.last_resolution = cached
+        return cached
+
+    def _resolve(self, headers):
+        normalized = [str(h).lower().strip() for h in headers]
+        candidates = {}
+        if self.mode == "target":
+            for target, alternatives in self.rules:
+                for alt in alternatives:
+                    pos = next((j for j, h in enumerate(normalized) if self._matches(h, alt)), None)
+                    if pos is not None:
+                        candidates.setdefault(target, []).append((0, pos))
+                        break
+        else:
+            for pos, h in enumerate(normalized):
+                for rule_idx, (target, alternatives) in enumerate(self.rules):
+                    if any(self._matches(h, alt) for alt in alternatives):
+                        candidates.setdefault(target, []).append((rule_idx, pos))
+                        break
+
+        mapping = {}
+        ambiguous = {}
+        for target, found in candidates.items():
+            found = sorted(found)
+            if len(found) > 1:
+                ambiguous[target] = [headers[pos] for _, pos in found]
+            for _, pos in (found[:1] if self.first_only else found):
+                mapping[headers[pos]] = target
+        # Ordem original dos cabeçalhos
+        mapping = {h: mapping[h] for h in headers if h in mapping}
+        unmapped = [h for h in headers if h not in mapping]
+        return SchemaResolution(mapping, unmapped, ambiguous)
+
+    def rename(self, df):
+        """Renomeia as colunas de `df` para os nomes padrão."""
+        return df.rename(columns=self.resolve(df.columns).mapping)
+
+# Aba 'Base de dados' da planilha principal (leitura em get_allocated_data e escrita em /api/edit e /api/add)
+ALLOCATED_SCHEMA = HeaderSchema("Base de dados", [
+    ('posicao', ['posi']),
+    ('produto', ['produto', 'sku']),
+    ('capacidade', ['capacidade']),
+    ('quantidade_total', ['quantidade total', 'qt total', 'total+qtd', 'total+qua', 'total+quant']),
+    ('paletes', ['palete+qtd+!/', 'palete+qua+!/']),
+    ('nivel', ['nivel', 'nível']),
+    ('profundidade', ['prof']),
+    ('qtd_por_palete', ['/+palete']),
+    ('id_palete', ['id+palete']),
+    ('qtd_tombada', ['tombada', 'tombado']),
+    ('qtd_molhado', ['molhado', 'molhada']),
+    ('observacao', ['status', 'observa', 'obse', 'avaria']),
+])
+
+REGISTERED_SCHEMA = HeaderSchema("Posições Cadastradas", [
+    ('posicao', ['posi']),
+    ('capacidade', ['capacidade']),
+    ('status', ['status']),
+    ('altura_pos', ['nivel', 'nível']),
+    ('prof_pos', ['prof']),
+    ('observacao_pos', ['observa']),
+])
+
+PRODUCT_SCHEMA = HeaderSchema("Inf dos produtos", [
+    ('produto', ['código', 'codigo']),
+    ('descricao', ['descrição', 'descricao']),
+])
+
+UNALLOCATED_SCHEMA = HeaderSchema("Não alocados", [
+    ('produto', ['produto']),
+    ('qtd_por_palete', ['quantidade no palete']),
+    ('paletes', ['qtd. de palete']),
+    ('quantidade_total', ['quantidade total']),
+    ('id_palete', ['id palete']),
+    ('qtd_tombada', ['parte tombada']),
+    ('qtd_molhado', ['parte molhada']),
+    ('observacao', ['observação']),
+], mode="target")
+
+MOVEMENT_SCHEMA = HeaderSchema("Movimentação", [
+    ('produto', ['produto', 'sku']),
+    ('entrada', ['entrada']),
+    ('saida', ['saída', 'saida', 'saíd', 'said']),
+    ('molhado', ['molhad']),
+    ('tombada', ['tombad']),
+    ('origem', ['origem', 'local', 'ponto']),
+    ('data', ['=data']),
+    # Sem uma coluna chamada exatamente "Data", vale a primeira que contenha "data"
+    ('data', ['data']),
+], first_only=True)
+
+QUANTITY_TOTALS_SCHEMA = HeaderSchema("Quantidade Total", [
+    ('molhado', ['molhad']),
+    ('tombado', ['tombad']),
+])
 
 def get_allocated_data(xl=None):
     try:
         if xl is None:
-            response = requests.get(EXCEL_URL, timeout=10)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
+            xl = get_workbook("main")
         # EXPLICAÇÃO: Especificando a aba 'Base de dados' para garantir que pegamos os dados corretos
-        df = pd.read_excel(xl, sheet_name='Base de dados')
+        df = xl.parse('Base de dados')
     except Exception as e:
         print(f"Erro ao carregar alocados: {e}")
         local_path = os.path.join(os.path.dirname(__file__), "data", "Drive atualizado.xlsx")
         if os.path.exists(local_path):
-            df = pd.read_excel(local_path)
+            df = pd.read_excel(local_path, engine=XLSX_ENGINE)
         else:
             return pd.DataFrame()
     
-    new_cols = {}
-    for col in df.columns:
-        c = str(col).lower()
-        if 'posi' in c: new_cols[col] = 'posicao'
-        elif 'produto' in c or 'sku' in c: new_cols[col] = 'produto'
-        elif 'capacidade' in c: new_cols[col] = 'capacidade'
-        elif 'quantidade total' in c or ('total' in c and ('qtd' in c or 'qua' in c or 'quant' in c)): new_cols[col] = 'quantidade_total'
-        elif 'palete' in c and ('qtd' in c or 'qua' in c) and '/' not in c: new_cols[col] = 'paletes'
-        elif 'nivel' in c or 'nível' in c: new_cols[col] = 'nivel'
-        elif 'prof' in c: new_cols[col] = 'profundidade'
-        elif '/' in c and 'palete' in c: new_cols[col] = 'qtd_por_palete'
-        elif 'id' in c and 'palete' in c: new_cols[col] = 'id_palete'
-        elif 'tombada' in c or 'tombado' in c: new_cols[col] = 'qtd_tombada'
-        elif 'molhado' in c or 'molhada' in c: new_cols[col] = 'qtd_molhado'
-        elif 'status' in c or 'observa' in c or 'obse' in c or 'avaria' in c: new_cols[col] = 'observacao'
-
-    df = df.rename(columns=new_cols)
-    return df
+    return ALLOCATED_SCHEMA.rename(df)
 
 def get_registered_positions(xl=None):
     try:
         if xl is None:
-            response = requests.get(EXCEL_URL, timeout=10)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
-        df = pd.read_excel(xl, sheet_name='Posições Cadastradas')
+            xl = get_workbook("main")
+        df = xl.parse('Posições Cadastradas')
     except Exception as e:
         print(f"Erro ao carregar posições cadastradas: {e}")
         return pd.DataFrame()
 
-    new_cols = {}
-    for col in df.columns:
-        c = str(col).lower()
-        if 'posi' in c: new_cols[col] = 'posicao'
-        elif 'capacidade' in c: new_cols[col] = 'capacidade'
-        elif 'status' in c: new_cols[col] = 'status'
-        elif 'nivel' in c or 'nível' in c: new_cols[col] = 'altura_pos'
-        elif 'prof' in c: new_cols[col] = 'prof_pos'
-        elif 'observa' in c: new_cols[col] = 'observacao_pos'
-    
-    df = df.rename(columns=new_cols)
-    return df
+    return REGISTERED_SCHEMA.rename(df)
 
 def get_product_descriptions(xl=None):
     try:
         if xl is None:
-            response = requests.get(EXCEL_URL, timeout=10)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
-        df = pd.read_excel(xl, sheet_name='Inf dos produtos')
+            xl = get_workbook("main")
+        df = xl.parse('Inf dos produtos')
     except Exception as e:
         print(f"Erro ao carregar descrições de produtos: {e}")
         return pd.DataFrame()
 
-    new_cols = {}
-    for col in df.columns:
-        c = str(col).lower()
-        if 'código' in c or 'codigo' in c: new_cols[col] = 'produto'
-        elif 'descrição' in c or 'descricao' in c: new_cols[col] = 'descricao'
-    
-    df = df.rename(columns=new_cols)
+    df = PRODUCT_SCHEMA.rename(df)
     return df[['produto', 'descricao']] if 'produto' in df.columns and 'descricao' in df.columns else df
 
+class ProductCatalog:
+    """Descrições dos produtos (aba 'Inf dos produtos') indexadas pelo código, uma por versão da planilha principal."""
+
+    def __init__(self, version, descriptions):
+        self.version = version
+        self.descriptions = descriptions
+        self._index = pd.Series(descriptions, dtype=object)
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def get(self, produto, default='-'):
+        return self.descriptions.get(str(produto).strip(), default)
+
+    def lookup_many(self, produtos, default='-'):
+        """Descrições de vários produtos de uma vez, alinhadas com `produtos` (Series ou lista)."""
+        produtos = pd.Series(produtos) if not isinstance(produtos, pd.Series) else produtos
+        keys = produtos.astype(str).str.strip()
+        found = keys.map(self._index) if len(self._index) else pd.Series(np.nan, index=produtos.index, dtype=object)
+        return found.astype(object).where(found.notna(), default)
+
+def _build_product_catalog(xl):
+    df_desc = get_product_descriptions(xl=xl)
+    descriptions = {}
+    if not df_desc.empty and 'produto' in df_desc.columns and 'descricao' in df_desc.columns:
+        df_desc = df_desc[df_desc['produto'].notna()]
+        keys = df_desc['produto'].astype(str).str.strip()
+        values = df_desc['descricao'].astype(object).where(df_desc['descricao'].notna(), '-').astype(str)
+        # Em códigos duplicados no cadastro vale a primeira descrição
+        descriptions = dict(zip(keys[::-1], values[::-1]))
+    return ProductCatalog(xl.hash, descriptions)
+
+def get_product_catalog(xl=None):
+    """Catálogo de produtos da planilha principal, montado uma vez por versão."""
+    if xl is None:
+        xl = get_workbook("main")
+    return xl.derived("product_catalog", _build_product_catalog)
+
 def get_unallocated_data(xl=None):
     try:
         if xl is None:
-            response = requests.get(UNALLOCATED_GSHEET_URL, timeout=10)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
-        df = pd.read_excel(xl)
+            xl = get_workbook("unallocated")
+        df = xl.parse(0)
     except Exception as e:
         print(f"Erro ao carregar não alocados: {e}")
         return pd.DataFrame()
 
-    col_mapping = {
-        'Produto': 'produto',
-        'Quantidade no palete': 'qtd_por_palete',
-        'Qtd. de palete': 'paletes',
-        'Quantidade total': 'quantidade_total',
-        'ID palete': 'id_palete',
-        'Parte Tombada': 'qtd_tombada',
-        'Parte Molhada': 'qtd_molhado',
-        'Observação': 'observacao'
-    }
-    
-    actual_cols = df.columns
-    final_mapping = {}
-    for target_name, final_name in col_mapping.items():
-        found = next((c for c in actual_cols if target_name.lower() in str(c).lower()), None)
-        if found:
-            final_mapping[found] = final_name
-
-    df = df.rename(columns=final_mapping)
+    df = UNALLOCATED_SCHEMA.rename(df)
     df['posicao'] = 'S/P'
     df['is_unallocated_source'] = True
     return df
 
-def get_movement_data(period: str = "hoje", xl=None):
-    try:
-        if xl is None:
-            # Usar XLSX para poder selecionar a aba correta se necessário
-            url_xlsx = MOVEMENT_GSHEET_URL.replace("format=csv", "format=xlsx")
-            print(f"DEBUG MOVEMENT: Baixando XLSX de {url_xlsx}")
-            response = requests.get(url_xlsx, timeout=15)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
-        # Tenta achar a aba com mais linhas que tenha as colunas necessárias (ENTRADA/SAIDA)
-        best_sheet = None
-        max_rows = -1
-        
-        # Prioridade absoluta para abas com nomes específicos
-        priority_sheets = ['registro', 'movimentação', 'movimentacao', 'movimentos']
-        
-        for s in xl.sheet_names:
-            tmp_df = xl.parse(s, nrows=10) # Lê só um pedaço pra checar colunas
-            cols = [str(c).lower().strip() for c in tmp_df.columns]
-            
-            # Critério: precisa ter produto E (entrada ou saida)
-            has_prod = any(k in cols for k in ['produto', 'sku'])
-            has_mov = any(k in cols for k in ['entrada', 'saida', 'saída', 'movimentação', 'movimentacao'])
-            
-            if has_prod and has_mov:
-                score = len(xl.parse(s))
-                # Dar um bônus enorme se o nome da aba for um dos favoritos
-                if s.lower().strip() in priority_sheets:
-                    score += 1000000
-                
-                if score > max_rows:
-                    max_rows = score
-                    best_sheet = s
+MOVEMENT_PRIORITY_SHEETS = ['registro', 'movimentação', 'movimentacao', 'movimentos']
+
+def find_movement_sheet(xl):
+    """Escolhe a aba do registro de movimentação usando só os metadados (cabeçalho e nº de linhas)."""
+    best_sheet = None
+    max_rows = -1
+    sheet_info = xl.sheet_info()
+
+    for s in xl.sheet_names:
+        n_rows, header = sheet_info[s]
+        cols = [str(c).lower().strip() for c in header]
         
-        if not best_sheet:
-            # Fallback total: tenta qualquer uma que tenha produto
-            for s in xl.sheet_names:
-                tmp_df = xl.parse(s, nrows=2)
-                cols = [str(c).lower().strip() for c in tmp_df.columns]
-                if any(k in cols for k in ['produto', 'sku']):
-                    best_sheet = s
-                    break
+        # Critério: precisa ter produto E (entrada ou saida)
+        has_prod = any(k in cols for k in ['produto', 'sku'])
+        has_mov = any(k in cols for k in ['entrada', 'saida', 'saída', 'movimentação', 'movimentacao'])
         
-        if not best_sheet:
-            best_sheet = xl.sheet_names[0]
-            print(f"DEBUG MOVEMENT: Nenhuma aba ideal. Usando a primeira: {best_sheet}")
+        if has_prod and has_mov:
+            score = n_rows
+            # Dar um bônus enorme se o nome da aba for um dos favoritos
+            if s.lower().strip() in MOVEMENT_PRIORITY_SHEETS:
+                score += 1000000
             
-        df = xl.parse(best_sheet)
-        print(f"DEBUG MOVEMENT: Selecionada aba '{best_sheet}' com {len(df)} linhas.")
-        
+            if score > max_rows:
+                max_rows = score
+                best_sheet = s
+    
+    if not best_sheet:
+        # Fallback total: tenta qualquer uma que tenha produto
+        for s in xl.sheet_names:
+            cols = [str(c).lower().strip() for c in sheet_info[s][1]]
+            if any(k in cols for k in ['produto', 'sku']):
+                best_sheet = s
+                break
+    
+    if not best_sheet:
+        best_sheet = xl.sheet_names[0]
+        print(f"DEBUG MOVEMENT: Nenhuma aba ideal. Usando a primeira: {best_sheet}")
+
+    return best_sheet
+
+def parse_num_column(series):
+    """Versão vetorizada de float(str(v).replace(',', '.')), com 0 para valores vazios ou inválidos."""
+    nums = pd.to_numeric(series.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+    return nums.replace([np.inf, -np.inf], np.nan).fillna(0.0).astype('float64')
+
+# Formatos testados em ordem antes do parser genérico (dia sempre primeiro)
+MOVEMENT_DATE_FORMATS = ['%d/%m/%Y', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M']
+
+def parse_movement_dates(values, today=None):
+    """Converte a coluna 'data' do registro de movimentação em datetime.
+
+    Cada valor distinto é convertido uma única vez, já que as mesmas datas se repetem
+    milhares de vezes. Aceita datas já tipadas, "dd/mm/aaaa" e "dd/mm" (ano atual);
+    o que não for reconhecido vira `today`.
+    """
+    if today is None:
+        today = pd.Timestamp.now().normalize()
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.fillna(today)
+
+    uniques = pd.Series(values.dropna().unique(), dtype=object)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+
+    # Valores que já são datas (células formatadas como data na planilha)
+    is_date = uniques.map(lambda v: isinstance(v, datetime.date))
+    if is_date.any():
+        parsed[is_date] = pd.to_datetime(uniques[is_date])
+
+    # Texto: "28/02" -> "28/02/ANO", depois formatos explícitos e por último o parser genérico
+    text = uniques[~is_date].astype(str).str.strip()
+    text = text[(text != '') & (text.str.lower() != 'nan')]
+    text = text.where(text.str.count('/') != 1, text + f"/{today.year}")
+    for fmt in MOVEMENT_DATE_FORMATS:
+        pending = text[parsed[text.index].isna()]
+        if pending.empty:
+            break
+        parsed[pending.index] = pd.to_datetime(pending, format=fmt, errors='coerce')
+    for i, s in text[parsed[text.index].isna()].items():
+        try:
+            parsed[i] = pd.to_datetime(s, dayfirst=True, errors='coerce')
+        except Exception:
+            pass
+
+    lookup = dict(zip(uniques, parsed))
+    return values.map(lookup).astype('datetime64[ns]').fillna(today)
+
+def _type_movement_rows(df, today):
+    """Converte linhas já renomeadas da aba de movimentação nas colunas tipadas do registro."""
+    ledger = pd.DataFrame(index=df.index)
+    ledger['produto'] = df['produto'].astype(str).fillna('nan').str.strip() if 'produto' in df.columns else '-'
+    if 'data' in df.columns:
+        # Se a data falhou mas o registro é recente (fim da planilha), dar um fallback
+        # para não perder registros importantes
+        ledger['dt'] = parse_movement_dates(df['data'], today)
+    else:
+        ledger['dt'] = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    for col in ['entrada', 'saida', 'molhado', 'tombada']:
+        ledger[col] = parse_num_column(df[col]) if col in df.columns else 0.0
+
+    if 'origem' in df.columns:
+        origem = df['origem'].astype(str).str.strip()
+        ledger['origem'] = origem.where(origem.notna() & (origem != '') & (origem.str.lower() != 'nan'), '-')
+    else:
+        ledger['origem'] = '-'
+    # Linhas de mapeamento/ajuste de inventário compõem o saldo, mas não são movimentações do dia a dia
+    ledger['is_ajuste'] = ledger['origem'].str.contains('Mapeamento|Ajuste', case=False, na=False)
+    return ledger
+
+def _cell_key(value):
+    if value is None or value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, (bool, int, float, np.bool_, np.integer, np.floating)):
+        # 5, 5.0 e True/1 são o mesmo valor, venha a coluna como int, float ou object
+        number = float(value)
+        return str(int(number)) if number.is_integer() else repr(number)
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    return str(value).strip()
+
+def _canonical_cells(series):
+    """Texto canônico de cada célula; cada valor distinto é convertido uma única vez."""
+    codes, uniques = pd.factorize(series.astype(object), use_na_sentinel=False)
+    keys = np.array([_cell_key(v) for v in uniques], dtype=object)
+    return pd.Series(keys[codes], index=series.index, dtype=object)
+
+class MovementAccumulator:
+    """Registro de movimentação ingerido de forma incremental.
+
+    A aba de movimentação só recebe linhas novas no final. Guardamos quantas linhas já foram
+    processadas (watermark) e um hash de cada uma delas; se todas as linhas já vistas continuam
+    iguais, só as linhas novas são convertidas e somadas aos saldos acumulados. Se o histórico foi
+    editado (alguma linha diferente, menos linhas, outro cabeçalho ou outro dia), tudo é refeito.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, signature):
+        self.signature = signature
+        self.watermark = 0
+        self.row_hashes = np.empty(0, dtype='uint64')
+        self.ledger = None
+        self.totals = {"entrada": 0.0, "saida": 0.0, "molhado": 0.0, "tombada": 0.0}
+        self.movement_by_product = {}
+        self.frequency_by_product = {}
+        self.molh_frequency_by_product = {}
+        self.net_by_day = {}
+        self.daily_by_product = None
+
+    @staticmethod
+    def _row_hashes(raw):
+        """Hash de cada linha a partir do texto canônico das células, que não depende do dtype da coluna."""
+        keys = pd.DataFrame({c: _canonical_cells(raw[c]) for c in raw.columns}, index=raw.index)
+        return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+    def ingest(self, xl):
+        """Atualiza o estado com a versão `xl` da planilha e retorna o resultado imutável dela."""
+        best_sheet = find_movement_sheet(xl)
+        raw = xl.parse(best_sheet)
         # Remover linhas totalmente vazias
-        df = df.dropna(how='all')
-        
-        # Padronizar colunas e mapear de forma robusta
-        actual_cols = [str(c).lower().strip() for c in df.columns]
-        df.columns = actual_cols
-        
-        new_cols = {}
-        for col in actual_cols:
-            if 'produto' in col or 'sku' in col: new_cols[col] = 'produto'
-            elif 'entrada' in col: new_cols[col] = 'entrada'
-            elif any(x in col for x in ['saída', 'saida', 'saíd', 'said']): new_cols[col] = 'saida'
-            elif 'origem' in col or 'local' in col or 'ponto' in col: new_cols[col] = 'origem'
-            elif 'molhado' in col: new_cols[col] = 'qtd_molhado'
-        
-        df = df.rename(columns=new_cols)
+        raw = raw.dropna(how='all').reset_index(drop=True)
+        today = pd.Timestamp.now().normalize()
+        signature = (best_sheet, tuple(str(c) for c in raw.columns), today)
+
+        row_hashes = self._row_hashes(raw)
+
+        with self._lock:
+            appended_only = (
+                self.signature == signature
+                and len(raw) >= self.watermark
+                and np.array_equal(row_hashes[:self.watermark], self.row_hashes)
+            )
+            if appended_only:
+                new_rows = raw.iloc[self.watermark:]
+                print(f"DEBUG MOVEMENT: {len(new_rows)} linhas novas na aba '{best_sheet}' (já processadas: {self.watermark}).")
+            else:
+                if self.signature is not None:
+                    print(f"DEBUG MOVEMENT: Histórico da aba '{best_sheet}' mudou. Reprocessando tudo.")
+                self._reset(signature)
+                new_rows = raw
+                print(f"DEBUG MOVEMENT: Selecionada aba '{best_sheet}' com {len(raw)} linhas.")
+
+            typed = _type_movement_rows(MOVEMENT_SCHEMA.rename(new_rows), today)
+            self._accumulate(typed, today)
+            self.ledger = typed if self.ledger is None else pd.concat([self.ledger, typed])
+            self.watermark = len(raw)
+            self.row_hashes = row_hashes
+            return self._state(today)
+
+    def _accumulate(self, typed, today):
+        for col in self.totals:
+            self.totals[col] += float(typed[col].sum())
+
+        # Drop empty products
+        valid = typed[~typed['produto'].isin(['nan', '-'])]
+        balanco = (valid['entrada'] - valid['saida']).groupby(valid['produto']).sum()
+        _add_counts(self.movement_by_product, balanco.to_dict())
+        _add_counts(self.frequency_by_product, valid.groupby('produto').size().to_dict())
+        wet = valid[valid['molhado'] > 0]
+        _add_counts(self.molh_frequency_by_product, wet.groupby('produto').size().to_dict())
+
+        dated = typed[typed['dt'].notna()]
+        net = (dated['entrada'] - dated['saida']).groupby(dated['dt'].dt.date).sum()
+        _add_counts(self.net_by_day, net.to_dict())
+
+        # Agregado diário por produto das movimentações do dia a dia (mesmos valores inteiros da listagem)
+        moves = typed[~typed['is_ajuste']]
+        daily = pd.DataFrame({
+            'entrada': np.trunc(moves['entrada']).astype('int64'),
+            'saida': np.trunc(moves['saida']).astype('int64'),
+            'molhado': np.trunc(moves['molhado']).astype('int64'),
+            'registros': 1,
+        }).groupby([moves['dt'].fillna(today).dt.normalize().rename('dia'), moves['produto']]).sum()
+        if self.daily_by_product is not None:
+            daily = self.daily_by_product.add(daily, fill_value=0).astype('int64')
+        self.daily_by_product = daily.sort_index()
+
+    def _state(self, today):
+        return {
+            "ledger": self.ledger,
+            "totals": dict(self.totals),
+            "movement_by_product": dict(self.movement_by_product),
+            "frequency_by_product": dict(self.frequency_by_product),
+            "molh_frequency_by_product": dict(self.molh_frequency_by_product),
+            "today_net": self.net_by_day.get(today.date(), 0.0),
+            "daily_by_product": self.daily_by_product,
+            "daily_totals": self.daily_by_product.groupby(level='dia').sum(),
+        }
+
+def _add_counts(target, increments):
+    for key, value in increments.items():
+        target[key] = target.get(key, 0) + value
+
+_movement_accumulator = MovementAccumulator()
+
+def get_movement_state(xl=None):
+    """Estado do registro de movimentação para uma versão da planilha (ingerido uma vez por versão)."""
+    if xl is None:
+        xl = get_workbook("movement")
+    today_key = pd.Timestamp.now().strftime('%Y-%m-%d')
+    return xl.derived(("movement_state", today_key), _movement_accumulator.ingest)
+
+def get_movement_ledger(xl=None):
+    """Registro de movimentação tipado, montado uma vez por versão da planilha.
 
-        # Filtro de Data
+    Colunas: produto, dt, entrada, saida, molhado, tombada, origem, is_ajuste (na ordem das linhas
+    da planilha). `dt` já tem o fallback para hoje; fica vazio se a planilha não tiver coluna de data.
+    """
+    return get_movement_state(xl)["ledger"]
+
+def period_bounds(period, today=None):
+    """(primeiro dia, último dia) de um período do dashboard; None significa sem limite."""
+    if today is None:
         today = pd.Timestamp.now().normalize()
-        print(f"DEBUG MOVEMENT: Hoje é {today}")
-        
-        if 'data' in df.columns:
-            def safe_parse_date(d):
-                try:
-                    if pd.isnull(d): return pd.NaT
-                    # Se já for data/timestamp, retorna direto
-                    if isinstance(d, (pd.Timestamp, datetime.datetime, datetime.date)):
-                        return pd.to_datetime(d)
-                    
-                    s = str(d).strip()
-                    if not s or s.lower() == 'nan': return pd.NaT
-                    
-                    # Tratar 28/02 -> 28/02/YEAR
-                    if '/' in s and len(s.split('/')) == 2:
-                        s += f"/{today.year}"
-                        
-                    return pd.to_datetime(s, dayfirst=True, errors='coerce')
-                except:
-                    return pd.NaT
-            
-            # Precisamos de datetime para o isinstance funcionar no apply
-            import datetime
-            df['dt'] = df['data'].apply(safe_parse_date)
-            
-            # Se a data falhou mas o registro é recente (fim da planilha), dar um fallback
-            # para não perder registros importantes
-            df['dt'] = df['dt'].fillna(today)
-            
-            valid_dates = df['dt'].notna().sum()
-            print(f"DEBUG MOVEMENT: {valid_dates} datas processadas (incluindo fallbacks) de {len(df)} linhas.")
+    if period == "hoje":
+        return today, today
+    if period == "semana":
+        # Inicia na segunda-feira da semana atual
+        return (today - pd.Timedelta(days=today.weekday())).normalize(), None
+    if period == "mensal":
+        return today - pd.Timedelta(days=365), None
+    return None, None # recente
+
+def top_moved_products(state, first_day=None, last_day=None, limit=10, catalog=None):
+    """Os `limit` produtos com mais peças movimentadas (entrada + saída) entre dois dias, a partir
+    dos agregados diários. Empates ficam na ordem do código do produto."""
+    daily = state["daily_by_product"]
+    days = daily.index.get_level_values('dia')
+    mask = np.ones(len(daily), dtype=bool)
+    if first_day is not None:
+        mask &= days >= first_day
+    if last_day is not None:
+        mask &= days <= last_day
+    per_product = daily[mask].groupby(level='produto').sum()
+    movimentacao = (per_product['entrada'] + per_product['saida']).nlargest(limit)
+    top = per_product.loc[movimentacao.index]
+
+    if catalog is None:
+        catalog = get_product_catalog()
+    return pd.DataFrame({
+        "produto": top.index,
+        "descricao": catalog.lookup_many(top.index),
+        "movimentacao": movimentacao.to_numpy(),
+        "entrada": top['entrada'].to_numpy(),
+        "saida": top['saida'].to_numpy(),
+        "molhado": top['molhado'].to_numpy(),
+        "registros": top['registros'].to_numpy(),
+    }).to_dict(orient="records")
+
+def get_period_totals(state, first_day=None, last_day=None):
+    """Entradas, saídas, molhado e nº de registros entre dois dias, somando os agregados diários."""
+    daily = state["daily_totals"]
+    if first_day is not None:
+        daily = daily[daily.index >= first_day]
+    if last_day is not None:
+        daily = daily[daily.index <= last_day]
+    return {col: int(daily[col].sum()) for col in ['entrada', 'saida', 'molhado', 'registros']}
+
+def get_movement_data(period: str = "hoje", xl=None, start=None, end=None, catalog=None):
+    """Movimentações do período (ou do intervalo start/end), das mais recentes para as mais antigas."""
+    try:
+        if start is not None or end is not None:
+            first_day, last_day = start, end
         else:
-            print("DEBUG MOVEMENT: Coluna 'data' não encontrada. Usando data atual.")
-            df['dt'] = today
+            first_day, last_day = period_bounds(period)
+        result = format_movements(get_movement_ledger(xl), first_day, last_day, catalog)
+        print(f"DEBUG MOVEMENT ({period}): Sucesso! {len(result)} últimas movimentações carregadas.")
+        return result
+    except Exception as e:
+        print(f"DEBUG MOVEMENT: EXCEÇÃO - {e}")
+        traceback.print_exc()
+        return []
 
-        # Garantir colunas essenciais
-        for essential in ['produto', 'entrada', 'saida', 'origem']:
-            if essential not in df.columns:
-                df[essential] = '-' if essential in ['produto', 'origem'] else 0
-        
-        if 'origem' in df.columns:
-            df = df[~df['origem'].astype(str).str.contains('Mapeamento|Ajuste', case=False, na=False)]
-
-        # Filtros de período
-        if period == "hoje":
-            df_filtered = df[df['dt'].dt.date == today.date()]
-        elif period == "semana":
-            # Inicia na segunda-feira da semana atual
-            monday = (today - pd.Timedelta(days=today.weekday())).normalize()
-            df_filtered = df[df['dt'] >= monday]
-        elif period == "mensal":
-            df_filtered = df[df['dt'] >= (today - pd.Timedelta(days=365))]
-        else: # recente
-            df_filtered = df
-            
-        print(f"DEBUG MOVEMENT ({period}): {len(df_filtered)} registros após filtro de período.")
-        
+def _most_recent_positions(values, k):
+    """Posições dos `k` maiores valores, em ordem decrescente de valor e, nos empates, da última
+    linha para a primeira. Seleção parcial: só os `k` escolhidos são ordenados."""
+    n = len(values)
+    kth = np.partition(values, n - k)[n - k]
+    greater = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[len(greater) - k:]
+    chosen = np.concatenate([greater, ties])
+    return chosen[np.lexsort((-chosen, -values[chosen]))]
+
+def format_movements(ledger, first_day=None, last_day=None, catalog=None, limit=None):
+    """Registros de movimentação (sem mapeamentos/ajustes) entre dois dias, no formato do dashboard.
+
+    Com `limit`, só os `limit` mais recentes são selecionados e formatados.
+    """
+    today = pd.Timestamp.now().normalize()
+    df = ledger[~ledger['is_ajuste']]
+    dts = df['dt'].fillna(today)
+
+    # Filtros de período
+    days = dts.dt.normalize()
+    mask = pd.Series(True, index=df.index)
+    if first_day is not None:
+        mask &= days >= first_day
+    if last_day is not None:
+        mask &= days <= last_day
+    df_filtered = df[mask].assign(dt=dts[mask])
+
+    if limit is not None and limit < len(df_filtered):
+        df_latest = df_filtered.iloc[_most_recent_positions(df_filtered['dt'].to_numpy().view('int64'), limit)]
+    else:
         # Pegar todos os registros ordenados por data DESC e por ordem de inserção DESC (últimas linhas primeiro)
         # Primeiro invertemos o DF para ter as últimas linhas no topo
         df_latest = df_filtered.iloc[::-1].sort_values('dt', ascending=False, kind='stable')
+    
+    # Buscar descrições
+    if catalog is None:
+        catalog = get_product_catalog()
+
+    # Monta todas as colunas de uma vez e converte em registros num único passo
+    prods = df_latest['produto']
+    entrada = np.trunc(df_latest['entrada']).astype('int64')
+    saida = np.trunc(df_latest['saida']).astype('int64')
+    molhado = np.trunc(df_latest['molhado']).astype('int64')
+
+    dts = df_latest['dt']
+    dias = np.array(["SEG", "TER", "QUA", "QUI", "SEX", "SAB", "DOM"])
+    meses = np.array(["JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET", "OUT", "NOV", "DEZ"])
+
+    records = pd.DataFrame({
+        "data": dts.dt.strftime('%d/%m/%Y'),
+        "dia_semana": dias[dts.dt.dayofweek.to_numpy()],
+        "mes": meses[dts.dt.month.to_numpy() - 1],
+        "produto": prods,
+        "movimentacao": entrada + saida,
+        "entrada": entrada,
+        "saida": saida,
+        "molhado": molhado,
+        "descricao": catalog.lookup_many(prods),
+        "origem": df_latest['origem'],
+        "trend": None
+    })
+    return records.to_dict(orient="records")
+
+def derive_position_columns(df):
+    """Profundidade em texto, rateio de paletes compartilhados, flags de avaria e ocupação, coluna a coluna."""
+    if 'profundidade' in df.columns:
+        # Profundidade como texto: vazio/NaN vira '-' e "2.0" vira "2"
+        depth = df['profundidade']
+        depth_str = depth.astype(str)
+        empty = depth.isna() | (depth_str.str.lower() == 'nan') | (depth_str.str.strip() == '')
+        depth_str = depth_str.str.strip().str.replace(r'\.0$', '', regex=True)
+        df['profundidade'] = depth_str.where(~empty, '-')
+    else:
+        df['profundidade'] = '-'
         
-        # Buscar descrições
-        df_desc = get_product_descriptions()
-        desc_map = df_desc.set_index('produto')['descricao'].to_dict() if not df_desc.empty else {}
+    df['id_palete'] = df['id_palete'].fillna('').astype(str).str.strip().replace('nan', '')
+    shared_mask = (df['id_palete'] != '') & (df['id_palete'] != '0') & (df['id_palete'] != 'None')
+    if shared_mask.any():
+        # Linhas com o mesmo ID de palete dividem 1 palete entre si
+        id_counts = df.loc[shared_mask, 'id_palete'].value_counts()
+        # A coluna inteira é refeita: com 'paletes' int64 a atribuição parcial de frações falha
+        df['paletes'] = np.where(shared_mask, 1.0 / df['id_palete'].map(id_counts), df['paletes'])
 
-        result = []
-        for _, row in df_latest.iterrows():
-            prod = str(row.get('produto', '-'))
-            try:
-                entrada = int(float(str(row.get('entrada', 0) or 0).replace(',', '.')))
-            except:
-                entrada = 0
-            try:
-                saida = int(float(str(row.get('saida', 0) or 0).replace(',', '.')))
-            except:
-                saida = 0
-            try:
-                molhado = int(float(str(row.get('qtd_molhado', 0) or 0).replace(',', '.')))
-            except:
-                molhado = 0
-            origem_val = str(row.get('origem', '-')).strip()
-            
-            if not origem_val or origem_val.lower() == 'nan':
-                origem_val = '-'
-            
-            dt_obj = pd.to_datetime(row['dt'])
-            dias = ["SEG", "TER", "QUA", "QUI", "SEX", "SAB", "DOM"]
-            meses = ["JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET", "OUT", "NOV", "DEZ"]
-            
-            result.append({
-                "data": dt_obj.strftime('%d/%m/%Y') if pd.notna(row.get('dt')) else "-",
-                "dia_semana": dias[dt_obj.weekday()] if pd.notna(row.get('dt')) else "-",
-                "mes": meses[dt_obj.month - 1] if pd.notna(row.get('dt')) else "-",
-                "produto": prod, 
-                "movimentacao": entrada + saida,
-                "entrada": entrada,
-                "saida": saida,
-                "molhado": molhado,
-                "descricao": str(desc_map.get(prod, "-")),
-                "origem": origem_val,
-                "trend": None
-            })
-        
-        print(f"DEBUG MOVEMENT: Sucesso! {len(result)} últimas movimentações carregadas.")
-        return result
-    except Exception as e:
-        print(f"DEBUG MOVEMENT: EXCEÇÃO - {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+    # Normalize damage columns
+    for col in ['qtd_tombada', 'qtd_molhado']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        else:
+            df[col] = 0.0
+
+    # Ensure is_unallocated_source exists and is boolean
+    if 'is_unallocated_source' not in df.columns:
+        df['is_unallocated_source'] = False
+    df['is_unallocated_source'] = df['is_unallocated_source'].fillna(False).astype(bool)
+
+    # Damage Logic (Subsets of Total) - Ensure metrics pick them up
+    # Check both product name and observation for damage keywords
+    # Robust check for "molhad" (covers molhado, molhada, molhados, etc.)
+    # and "tombad" (covers tombado, tombada, etc.)
+    prod_text = df['produto'].astype(str).str.lower()
+    obs_text = df['observacao'].astype(str).str.lower()
+    def has_keyword(keyword):
+        return prod_text.str.contains(keyword, regex=False, na=False) | obs_text.str.contains(keyword, regex=False, na=False)
+
+    df['is_molhado'] = (has_keyword('molhad') | (df['qtd_molhado'] > 0)).astype(int)
+    df['is_tombado'] = (has_keyword('tombad') | (df['qtd_tombada'] > 0)).astype(int)
+
+    # FIX: Occupancy and Capacity should only apply to ALLOCATED items
+    # Unallocated items (is_unallocated_source == True) should have 0 capacity and 0 contribution to occupied positions
+    has_capacity = (~df['is_unallocated_source']) & (df['capacidade'] > 0)
+    df['ocupacao'] = np.where(has_capacity, df['paletes'] / df['capacidade'].where(has_capacity, 1) * 100, 0.0)
+    
+    return df
 
 def get_clean_data(xl=None, unalloc_xl=None):
     df_reg = get_registered_positions(xl=xl)
@@ -398,81 +1073,11 @@ def get_clean_data(xl=None, unalloc_xl=None):
     df['qtd_tombada'] = pd.to_numeric(df['qtd_tombada'], errors='coerce').fillna(0)
     df['qtd_molhado'] = pd.to_numeric(df['qtd_molhado'], errors='coerce').fillna(0)
     
-    def clean_depth(val):
-        if pd.isna(val) or str(val).lower() == 'nan' or str(val).strip() == '':
-            return '-'
-        v_str = str(val).strip()
-        if v_str.endswith('.0'): v_str = v_str[:-2]
-        return v_str
-
-    if 'profundidade' in df.columns:
-        df['profundidade'] = df['profundidade'].apply(clean_depth)
-    else:
-        df['profundidade'] = '-'
-        
     # 4. Adicionar descrições dos produtos
-    df_desc = get_product_descriptions()
-    if not df_desc.empty and 'produto' in df_desc.columns:
-        # Garantir que os tipos batem para o merge
-        df['produto'] = df['produto'].astype(str)
-        df_desc['produto'] = df_desc['produto'].astype(str)
-        # Remover duplicatas se houver no cadastro de descrições
-        df_desc = df_desc.drop_duplicates(subset=['produto'])
-        df = pd.merge(df, df_desc, on='produto', how='left')
+    df['descricao'] = get_product_catalog(xl).lookup_many(df['produto']).astype(str)
     
-    if 'descricao' not in df.columns:
-        df['descricao'] = '-'
-    else:
-        df['descricao'] = df['descricao'].fillna('-').astype(str)
-    
-    df['id_palete'] = df['id_palete'].fillna('').astype(str).str.strip().replace('nan', '')
-    shared_mask = (df['id_palete'] != '') & (df['id_palete'] != '0') & (df['id_palete'] != 'None')
-    if shared_mask.any():
-        id_counts = df[shared_mask]['id_palete'].value_counts()
-        def balance_pallet(row):
-            if row['id_palete'] != '' and row['id_palete'] != '0' and row['id_palete'] != 'None':
-                count = id_counts.get(row['id_palete'], 1)
-                return 1.0 / count
-            return row['paletes']
-        df['paletes'] = df.apply(balance_pallet, axis=1)
+    df = derive_position_columns(df)
 
-    # Normalize damage columns
-    for col in ['qtd_tombada', 'qtd_molhado']:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        else:
-            df[col] = 0.0
-
-    # Ensure is_unallocated_source exists and is boolean
-    if 'is_unallocated_source' not in df.columns:
-        df['is_unallocated_source'] = False
-    df['is_unallocated_source'] = df['is_unallocated_source'].fillna(False).astype(bool)
-
-    # Damage Logic (Subsets of Total) - Ensure metrics pick them up
-    def check_damage_flag(row):
-        # Check both product name and observation for damage keywords
-        text = (str(row.get('produto', '')) + " " + str(row.get('observacao', ''))).lower()
-        # Robust check for "molhad" (covers molhado, molhada, molhados, etc.)
-        # and "tombad" (covers tombado, tombada, etc.)
-        is_molhado = 1 if 'molhad' in text or row.get('qtd_molhado', 0) > 0 else 0
-        is_tombado = 1 if 'tombad' in text or row.get('qtd_tombada', 0) > 0 else 0
-        return pd.Series([is_molhado, is_tombado], index=['is_molhado', 'is_tombado'])
-
-    df[['is_molhado', 'is_tombado']] = df.apply(check_damage_flag, axis=1)
-
-    # FIX: Occupancy and Capacity should only apply to ALLOCATED items
-    # Unallocated items (is_unallocated_source == True) should have 0 capacity and 0 contribution to occupied positions
-    def calculate_occupancy(row):
-        if row.get('is_unallocated_source', False):
-            return 0.0
-        cap = row.get('capacidade', 0)
-        pal = row.get('paletes', 0)
-        if cap > 0:
-            return (pal / cap) * 100
-        return 0.0
-
-    df['ocupacao'] = df.apply(calculate_occupancy, axis=1)
-    
     # Ensure capacity is 0 for unallocated items to avoid skewing stats
     df.loc[df['is_unallocated_source'] == True, 'capacidade'] = 0.0
 
@@ -494,197 +1099,312 @@ def get_clean_data(xl=None, unalloc_xl=None):
     print(f"DEBUG: {len(df)} registros processados.")
     return df
 
+# Tipos compactos para o DataFrame que fica em memória no snapshot: textos repetidos viram
+# category e colunas numéricas só com inteiros são reduzidas ao menor tipo que comporta os valores.
+# Somas e agrupamentos do pandas sobem o tipo de volta (int64), então os totais não estouram.
+CATEGORY_MAX_RATIO = 0.5
+
+def compact_frame(df):
+    """Cópia de `df` com tipos menores e os mesmos valores."""
+    out = {}
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_bool_dtype(s):
+            out[col] = s
+        elif pd.api.types.is_numeric_dtype(s):
+            integral = not pd.api.types.is_float_dtype(s) or (np.isfinite(s) & (s % 1 == 0)).all()
+            out[col] = pd.to_numeric(s, downcast='integer') if integral else s
+        elif len(s) and s.nunique(dropna=False) <= len(s) * CATEGORY_MAX_RATIO:
+            # O fillna(0) deixa 0 no meio de colunas de texto/booleanas; numa category 0 e False
+            # virariam a mesma categoria, então essas colunas mistas ficam como estão
+            kinds = set(map(type, s.unique()))
+            out[col] = s if bool in kinds and len(kinds) > 1 else s.astype('category')
+        else:
+            out[col] = s
+    return pd.DataFrame(out, index=df.index)
+
+def frame_memory_report(df):
+    """Bytes ocupados por coluna (contando o conteúdo dos textos)."""
+    usage = df.memory_usage(deep=True, index=False)
+    return {
+        "rows": len(df),
+        "bytes": int(usage.sum()),
+        "columns": {c: {"dtype": str(df[c].dtype), "bytes": int(usage[c])} for c in df.columns},
+    }
+
 @app.get("/")
 async def health_check():
     return {"status": "ok"}
 
-@app.get("/api/data")
-async def read_data():
+@app.get("/api/schema")
+async def get_schema_report():
+    """Como os cabeçalhos das planilhas foram mapeados na última leitura de cada aba."""
+    return {name: (schema.last_resolution.as_dict() if schema.last_resolution else None)
+            for name, schema in HeaderSchema.registry.items()}
+
+@app.get("/api/memory")
+async def get_memory_report(response: Response):
+    """Quanto o snapshot publicado ocupa em memória: clean_data por coluna e planilhas em cache."""
+    snap = await get_snapshot()
+    set_snapshot_headers(response, snap)
+    return {
+        "snapshot_version": snap.version,
+        "clean_data": snap.memory,
+        "workbooks": {name: len(wb.content) for name, wb in snap.workbooks.items()},
+        "derived": sorted(str(k) for k in snap._derived),
+        "history": list(_snapshot_history),
+    }
+
+# EXPLICAÇÃO: "records" é a lista de objetos de sempre; "columnar" é {coluna: [valores]},
+# bem menor porque os nomes das colunas não se repetem a cada linha
+DATA_FORMATS = ("records", "columnar")
+
+def frame_payload(df, format="records"):
+    if format == "columnar":
+        return {c: df[c].tolist() for c in df.columns}
+    return df.to_dict(orient="records")
+
+def serialize_data(df, format="records"):
+    return dumps_json(frame_payload(df, format))
+
+# Filtros do /api/data respondidos por índices montados uma vez por snapshot (Snapshot.derived):
+# posições ordenadas para busca por prefixo, valor -> linhas para igualdade e ordem pré-calculada
+# por coluna para o sort. Cada índice só é montado na primeira requisição que precisa dele.
+DATA_FLAG_FILTERS = ("is_blocked", "is_molhado", "is_tombado", "is_unallocated_source")
+
+def _normalize_key(values):
+    return values.astype(str).str.strip().str.lower()
+
+def _prefix_index(snap, col):
+    """(valores ordenados, linhas na mesma ordem) para achar um prefixo com searchsorted."""
+    def build(s):
+        keys = _normalize_key(s.clean_data[col]).reset_index(drop=True).sort_values(kind='stable')
+        return keys.to_numpy(dtype=object), keys.index.to_numpy()
+    return snap.derived(("prefix_index", col), build)
+
+def _value_index(snap, col):
+    """valor normalizado -> linhas (em ordem) que têm esse valor."""
+    def build(s):
+        keys = _normalize_key(s.clean_data[col]).to_numpy()
+        return pd.Series(np.arange(len(keys))).groupby(keys).indices
+    return snap.derived(("value_index", col), build)
+
+def _flag_index(snap, col):
+    """Linhas em que a flag é verdadeira."""
+    return snap.derived(("flag_index", col), lambda s: np.flatnonzero(s.clean_data[col].astype(bool).to_numpy()))
+
+def _sort_order(snap, col, descending):
+    """Posições das linhas ordenadas pela coluna (estável, textos comparados como texto)."""
+    def build(s):
+        values = s.clean_data[col].reset_index(drop=True)
+        if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            values = values.astype(str)
+        return values.sort_values(ascending=not descending, kind='stable').index.to_numpy()
+    return snap.derived(("sort_order", col, descending), build)
+
+def filter_rows(snap, posicao=None, produto=None, status=None, flags=None):
+    """Linhas (posições, em ordem) do clean_data que passam nos filtros; None = todas."""
+    rows = None
+
+    def narrow(found):
+        nonlocal rows
+        found = np.sort(found)
+        rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+
+    if posicao:
+        keys, order = _prefix_index(snap, 'posicao')
+        prefix = posicao.strip().lower()
+        lo = np.searchsorted(keys, prefix, side='left')
+        hi = np.searchsorted(keys, prefix + '\uffff', side='left')
+        narrow(order[lo:hi])
+    for col, wanted in (('produto', produto), ('status', status)):
+        if wanted:
+            index = _value_index(snap, col)
+            keys = {v.strip().lower() for v in wanted.split(',') if v.strip()}
+            found = [index[k] for k in keys if k in index]
+            narrow(np.concatenate(found) if found else np.array([], dtype=np.intp))
+    for col, wanted in (flags or {}).items():
+        if wanted is not None:
+            hits = _flag_index(snap, col)
+            if not wanted:
+                hits = np.setdiff1d(np.arange(len(snap.clean_data)), hits, assume_unique=True)
+            narrow(hits)
+    return rows
+
+def encode_cursor(version, offset):
+    return base64.urlsafe_b64encode(f"{version}:{offset}".encode()).decode()
+
+def decode_cursor(cursor, version):
+    """Offset guardado no cursor. 400 se for inválido, 409 se foi gerado para outro snapshot."""
     try:
-        main_xl_content = requests.get(EXCEL_URL, timeout=30).content
-        main_xl = pd.ExcelFile(io.BytesIO(main_xl_content))
-        unalloc_xl_content = requests.get(UNALLOCATED_GSHEET_URL, timeout=30).content
-        unalloc_xl = pd.ExcelFile(io.BytesIO(unalloc_xl_content))
-        
-        df = get_clean_data(xl=main_xl, unalloc_xl=unalloc_xl)
-        return df.to_dict(orient="records")
-    except Exception as e:
-        traceback.print_exc()
-        # Se falhar o download de 30s, tenta o fallback pelo comportamento padrão
+        cursor_version, offset = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit(":", 1)
+        offset = int(offset)
+    except Exception:
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    if cursor_version != version:
+        raise HTTPException(status_code=409, detail="Os dados mudaram desde o cursor; recomece a paginação.")
+    return offset
+
+def data_page_body(snap, columns, filters, sort, offset, limit, format):
+    """Corpo JSON de uma consulta filtrada/paginada ao clean_data do snapshot."""
+    df = snap.clean_data
+    rows = filter_rows(snap, **filters)
+    if sort:
+        order = _sort_order(snap, sort.lstrip('-'), sort.startswith('-'))
+        if rows is not None:
+            keep = np.zeros(len(df), dtype=bool)
+            keep[rows] = True
+            order = order[keep[order]]
+        rows = order
+    elif rows is None:
+        rows = np.arange(len(df))
+
+    total = len(rows)
+    end = total if limit is None else offset + limit
+    page = df.iloc[rows[offset:end]][columns]
+    return dumps_json({
+        "total_filtrado": total,
+        "proximo_cursor": encode_cursor(snap.version, end) if end < total else None,
+        "dados": frame_payload(page, format),
+    })
+
+@app.get("/api/data")
+async def read_data(request: Request, format: str = "records", fields: Optional[str] = None, posicao: Optional[str] = None,
+                    produto: Optional[str] = None, status: Optional[str] = None,
+                    is_blocked: Optional[bool] = None, is_molhado: Optional[bool] = None,
+                    is_tombado: Optional[bool] = None, is_unallocated_source: Optional[bool] = None,
+                    sort: Optional[str] = None, limit: Optional[int] = None, cursor: Optional[str] = None):
+    if format not in DATA_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format deve ser um de: {', '.join(DATA_FORMATS)}")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit deve ser maior que zero")
+    flags = {"is_blocked": is_blocked, "is_molhado": is_molhado, "is_tombado": is_tombado,
+             "is_unallocated_source": is_unallocated_source}
+    query = [fields, posicao, produto, status, sort, limit, cursor, *flags.values()]
+
+    snap = await get_snapshot()
+    cached = not_modified(request, snap)
+    if cached is not None:
+        return cached
+    if all(v is None for v in query):
         try:
-            df = get_clean_data()
-            return df.to_dict(orient="records")
-        except:
+            # Sem filtros: o corpo é serializado uma vez por versão do snapshot e reaproveitado
+            body = await run_blocking(snap.derived, ("data_body", format), lambda s: serialize_data(s.clean_data, format))
+        except Exception as e:
+            traceback.print_exc()
             raise HTTPException(status_code=500, detail=str(e))
+        response = Response(content=body, media_type="application/json")
+        set_snapshot_headers(response, snap, request)
+        return response
+
+    df = snap.clean_data
+    columns = [c.strip() for c in fields.split(',') if c.strip()] if fields else list(df.columns)
+    sort_col = sort.lstrip('-') if sort else None
+    unknown = [c for c in columns + ([sort_col] if sort_col else []) if c not in df.columns]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Colunas desconhecidas: {', '.join(unknown)}")
+    offset = decode_cursor(cursor, snap.version) if cursor else 0
 
-def get_movement_totals(xl=None):
     try:
-        if xl is None:
-            # Usar XLSX para consistência
-            url_xlsx = MOVEMENT_GSHEET_URL.replace("format=csv", "format=xlsx")
-            print(f"DEBUG MOVEMENT TOTALS: Baixando XLSX de {url_xlsx}")
-            response = requests.get(url_xlsx, timeout=15)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
-        best_sheet = None
-        max_rows = -1
-        
-        # Prioridade absoluta para abas com nomes específicos
-        priority_sheets = ['registro', 'movimentação', 'movimentacao', 'movimentos']
-        
-        for s in xl.sheet_names:
-            tmp_df = xl.parse(s, nrows=10)
-            cols = [str(c).lower().strip() for c in tmp_df.columns]
-            
-            # Critério: precisa ter produto E (entrada ou saida)
-            has_prod = any(k in cols for k in ['produto', 'sku'])
-            has_mov = any(k in cols for k in ['entrada', 'saida', 'saída', 'movimentação', 'movimentacao'])
-            
-            if has_prod and has_mov:
-                score = len(xl.parse(s))
-                if s.lower().strip() in priority_sheets:
-                    score += 1000000
-                
-                if score > max_rows:
-                    max_rows = score
-                    best_sheet = s
-        
-        if not best_sheet:
-            for s in xl.sheet_names:
-                tmp_df = xl.parse(s, nrows=2)
-                cols = [str(c).lower().strip() for c in tmp_df.columns]
-                if any(k in cols for k in ['produto', 'sku']):
-                    best_sheet = s
-                    break
-        
-        if not best_sheet:
-            best_sheet = xl.sheet_names[0]
-            
-        df = xl.parse(best_sheet)
-        print(f"DEBUG MOVEMENT TOTALS: Selecionada aba '{best_sheet}' com {len(df)} linhas.")
-        
-        # Remover linhas totalmente vazias
-        df = df.dropna(how='all')
-        
-        # Normalizar colunas: lowercase, sem espaços e removendo caracteres estranhos se necessário
-        actual_cols = df.columns.tolist()
-        new_cols = {}
-        for col in actual_cols:
-            c = str(col).lower().strip()
-            if 'produto' in c or 'sku' in c: new_cols[col] = 'produto'
-            elif 'entrada' in c: new_cols[col] = 'entrada'
-            elif any(x in c for x in ['saída', 'saida', 'saíd', 'said']): new_cols[col] = 'saida' 
-            elif 'molhado' in c: new_cols[col] = 'qtd_molhado'
-            elif 'tombado' in c: new_cols[col] = 'qtd_tombada'
-            elif 'obser' in c: new_cols[col] = 'observacao'
-            elif 'origem' in c or 'local' in c or 'ponto' in c: new_cols[col] = 'origem'
-            elif 'data' in c: new_cols[col] = 'data'
-
-        df = df.rename(columns=new_cols)
-        print(f"DEBUG MOVEMENT: Colunas mapeadas: {df.columns.tolist()}")
-
-        def parse_num(v):
-            try:
-                if pd.isna(v) or str(v).strip() == '': return 0.0
-                return float(str(v).replace(',', '.'))
-            except:
-                return 0.0
+        filters = {"posicao": posicao, "produto": produto, "status": status, "flags": flags}
+        body = await run_blocking(data_page_body, snap, columns, filters, sort, offset, limit, format)
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    response = Response(content=body, media_type="application/json")
+    set_snapshot_headers(response, snap, request)
+    return response
+
+# Linhas do clean_data são identificadas por (posicao, produto, id_palete); quando a mesma chave
+# aparece mais de uma vez, a ordem de ocorrência desempata.
+CHANGE_KEY = ['posicao', 'produto', 'id_palete']
+
+def _change_keys(df):
+    keys = pd.DataFrame({c: df[c].astype(str).to_numpy() for c in CHANGE_KEY})
+    keys['ocorrencia'] = keys.groupby(CHANGE_KEY, sort=False).cumcount()
+    return pd.MultiIndex.from_frame(keys)
+
+def compute_changes(old_df, new_df):
+    """Linhas adicionadas, modificadas (já com os valores novos) e removidas (só a chave) entre duas versões."""
+    old_keys, new_keys = _change_keys(old_df), _change_keys(new_df)
+    columns = new_df.columns.union(old_df.columns, sort=False)
+
+    # Posição na versão antiga de cada linha da nova (-1 = linha nova)
+    matched = pd.Series(np.arange(len(old_keys)), index=old_keys).reindex(new_keys).fillna(-1).to_numpy(dtype=int)
+    common = np.flatnonzero(matched >= 0)
+    before = old_df.iloc[matched[common]].reindex(columns=columns).astype(object).to_numpy()
+    after = new_df.iloc[common].reindex(columns=columns).astype(object).to_numpy()
+    modified = common[(before != after).any(axis=1)]
+    removed = np.flatnonzero(~old_keys.isin(new_keys))
+
+    return {
+        "added": frame_payload(new_df.iloc[np.flatnonzero(matched < 0)]),
+        "modified": frame_payload(new_df.iloc[modified]),
+        "removed": frame_payload(old_df.iloc[removed][CHANGE_KEY]),
+    }
 
-        if 'entrada' in df.columns:
-            df['entrada_num'] = df['entrada'].apply(parse_num)
-        else:
-            df['entrada_num'] = 0.0
-            
-        if 'saida' in df.columns:
-            df['saida_num'] = df['saida'].apply(parse_num)
-        else:
-            df['saida_num'] = 0.0
+@app.get("/api/data/changes")
+async def get_data_changes(request: Request, since: str):
+    """O que mudou no /api/data desde a versão `since` (X-Snapshot-Version de uma resposta anterior)."""
+    snap = await get_snapshot()
+    cached = not_modified(request, snap)
+    if cached is not None:
+        return cached
+    old = snap.clean_data if since == snap.version else _snapshot_history.get(since)
+    if old is None:
+        raise HTTPException(status_code=410, detail="Versão fora do histórico; baixe o /api/data completo.")
+    try:
+        body = await run_blocking(snap.derived, ("changes", since), lambda s: dumps_json({
+            "since": since,
+            "version": s.version,
+            **compute_changes(old, s.clean_data),
+        }))
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    response = Response(content=body, media_type="application/json")
+    set_snapshot_headers(response, snap, request)
+    return response
 
-        # Calcular total de hoje (ENTRADA - SAÍDA) para o indicador do Dashboard
-        today = pd.Timestamp.now().normalize()
-        today_net = 0
-        
-        if 'data' in df.columns:
-            def safe_parse_date(d):
-                try:
-                    if pd.isnull(d): return pd.NaT
-                    if isinstance(d, (pd.Timestamp, datetime.datetime, datetime.date)):
-                        return pd.to_datetime(d)
-                    s = str(d).strip()
-                    if not s or s.lower() == 'nan': return pd.NaT
-                    if '/' in s and len(s.split('/')) == 2:
-                        s += f"/{today.year}"
-                    return pd.to_datetime(s, dayfirst=True, errors='coerce')
-                except:
-                    return pd.NaT
-            
-            import datetime
-            df['dt'] = df['data'].apply(safe_parse_date).fillna(today)
-            df_today = df[df['dt'].dt.date == today.date()]
-            today_ent = df_today['entrada_num'].sum()
-            today_sai = df_today['saida_num'].sum()
-            today_net = int(today_ent - today_sai)
-
-        ent = df['entrada_num'].sum()
-        sai = df['saida_num'].sum()
-        molh = df['qtd_molhado'].apply(parse_num).sum() if 'qtd_molhado' in df.columns else 0
-        tomb = df['qtd_tombada'].apply(parse_num).sum() if 'qtd_tombada' in df.columns else 0
-        
-        # Calculate totals per product
-        if 'produto' in df.columns:
-            df['balanco'] = df['entrada_num'] - df['saida_num']
-            # Group by string to avoid NaN issues
-            df['produto_str'] = df['produto'].astype(str).str.strip()
-            # Drop empty products
-            valid_prods = df[df['produto_str'] != 'nan']
-            
-            prod_groups = valid_prods.groupby('produto_str')['balanco'].sum().to_dict()
-            
-            # EXPLICAÇÃO: Frequência de registros (quantas vezes o SKU aparece no log de movimentação)
-            freq_groups = valid_prods.groupby('produto_str').size().to_dict()
-            
-            # EXPLICAÇÃO: Frequência de registros COM avaria molhada
-            molh_freq_groups = {}
-            if 'qtd_molhado' in valid_prods.columns:
-                # Considera registro de avaria se a quantidade for > 0 ou se o campo não estiver vazio
-                wet_prods = valid_prods[valid_prods['qtd_molhado'].apply(parse_num) > 0]
-                molh_freq_groups = wet_prods.groupby('produto_str').size().to_dict()
-        else:
-            prod_groups = {}
-            freq_groups = {}
-            molh_freq_groups = {}
+def get_movement_totals(xl=None):
+    try:
+        state = get_movement_state(xl)
+        totals = state["totals"]
+        ent = totals["entrada"]
+        sai = totals["saida"]
 
         return {
             "movement_pieces": int(ent - sai),
-            "today_net": today_net,
+            # Total de hoje (ENTRADA - SAÍDA) para o indicador do Dashboard
+            "today_net": int(state["today_net"]),
             "total_entries": int(ent),
             "total_exits": int(sai),
-            "qtd_molhado": int(molh),
-            "qtd_tombada": int(tomb),
-            "movement_by_product": prod_groups,
-            "frequency_by_product": freq_groups,
-            "molh_frequency_by_product": molh_freq_groups
+            "qtd_molhado": int(totals["molhado"]),
+            "qtd_tombada": int(totals["tombada"]),
+            "movement_by_product": state["movement_by_product"],
+            # EXPLICAÇÃO: Frequência de registros (quantas vezes o SKU aparece no log de movimentação)
+            "frequency_by_product": state["frequency_by_product"],
+            # EXPLICAÇÃO: Frequência de registros COM avaria molhada
+            "molh_frequency_by_product": state["molh_frequency_by_product"]
         }
     except Exception as e:
         print(f"DEBUG MOVEMENT TOTALS: Erro - {e}")
         return {"movement_pieces": 0, "qtd_molhado": 0, "qtd_tombada": 0, "movement_by_product": {}}
 
+def find_quantity_sheet(xl):
+    """Primeira aba cujo nome lembra 'Quantidade Total', ou None."""
+    return next((s for s in xl.sheet_names if 'quantidade' in s.lower() or 'total' in s.lower()), None)
+
 def get_quantity_totals(xl=None):
     """Lê a aba 'Quantidade Total' da planilha de movimentação para pegar molhado/tombada."""
     try:
         if xl is None:
-            url_xlsx = MOVEMENT_GSHEET_URL.replace("format=csv", "format=xlsx")
-            response = requests.get(url_xlsx, timeout=15)
-            response.raise_for_status()
-            xl = pd.ExcelFile(io.BytesIO(response.content))
+            xl = get_workbook("movement")
 
         # Procurar a aba correta
-        aba = None
-        for s in xl.sheet_names:
-            if 'quantidade' in s.lower() or 'total' in s.lower():
-                aba = s
-                break
-        
+        aba = find_quantity_sheet(xl)
         if not aba:
             print("DEBUG QUANTITY TOTALS: Aba 'Quantidade Total' não encontrada.")
             return {"qtd_molhado": 0, "qtd_tombada": 0}
@@ -694,23 +1414,10 @@ def get_quantity_totals(xl=None):
         print(f"DEBUG QUANTITY TOTALS: Lida aba '{aba}' com {len(df)} linhas. Colunas: {df.columns.tolist()}")
 
         # Mapear colunas
-        col_map = {}
-        for col in df.columns:
-            c = str(col).lower().strip()
-            if 'molhad' in c: col_map[col] = 'molhado'
-            elif 'tombad' in c: col_map[col] = 'tombado'
-
-        df = df.rename(columns=col_map)
+        df = QUANTITY_TOTALS_SCHEMA.rename(df)
 
-        def parse_num(v):
-            try:
-                if pd.isna(v) or str(v).strip() == '': return 0.0
-                return float(str(v).replace(',', '.'))
-            except:
-                return 0.0
-
-        qtd_molhado = int(df['molhado'].apply(parse_num).sum()) if 'molhado' in df.columns else 0
-        qtd_tombada = int(df['tombado'].apply(parse_num).sum()) if 'tombado' in df.columns else 0
+        qtd_molhado = int(parse_num_column(df['molhado']).sum()) if 'molhado' in df.columns else 0
+        qtd_tombada = int(parse_num_column(df['tombado']).sum()) if 'tombado' in df.columns else 0
 
         # Count unique SKUs from "Quantidade Total" only
         total_skus = 0
@@ -726,244 +1433,842 @@ def get_quantity_totals(xl=None):
         traceback.print_exc()
         return {"qtd_molhado": 0, "qtd_tombada": 0}
 
-# Cache global para evitar downloads excessivos (expira em 30s)
-_xlsx_cache = {"data": None, "time": 0.0}        # Planilha de movimentação
-_main_xlsx_cache = {"data": None, "time": 0.0}   # Planilha principal (EXCEL_URL)
+# EXPLICAÇÃO: Os endpoints de leitura não processam mais as planilhas a cada requisição.
+# Uma thread em segundo plano baixa as três planilhas, roda o processamento completo uma vez e
+# publica um Snapshot imutável. As requisições sempre respondem com o último snapshot válido
+# (informando a idade dele) enquanto a atualização acontece por trás.
+SNAPSHOT_REFRESH_INTERVAL = float(os.environ.get("SNAPSHOT_REFRESH_INTERVAL", "60"))
+# "recente" (o registro inteiro) não é pré-calculado: só serve de fallback para períodos desconhecidos
+# (ver period_movements) e as últimas movimentações saem de uma consulta top-K
+MOVEMENT_PERIODS = ["hoje", "semana", "mensal"]
+
+@dataclass(frozen=True)
+class Snapshot:
+    """Resultado de um processamento completo. Não deve ser modificado depois de publicado."""
+    version: str
+    built_at: float
+    source_hashes: dict
+    clean_data: pd.DataFrame
+    movement_totals: dict
+    quantity_totals: dict
+    movements: dict
+    movement_state: dict
+    workbooks: dict
+    # Uso de memória do clean_data (antes/depois da compactação), para o /api/memory
+    memory: dict = field(default_factory=dict)
+    # Visões calculadas sob demanda a partir deste snapshot (ver Snapshot.derived)
+    _derived: dict = field(default_factory=dict, repr=False, compare=False)
+    _lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    def derived(self, key, builder):
+        """Resultado calculado a partir deste snapshot, calculado uma única vez por versão."""
+        with self._lock:
+            if key not in self._derived:
+                self._derived[key] = builder(self)
+            return self._derived[key]
+
+_snapshot_state = {"snapshot": None, "verified_at": 0.0, "refreshing": False}
+_snapshot_lock = threading.Lock()
+
+# EXPLICAÇÃO: clean_data das últimas SNAPSHOT_HISTORY versões publicadas (da mais antiga para a mais
+# nova), para o /api/data/changes calcular o que mudou desde a versão que o cliente já tem
+SNAPSHOT_HISTORY = int(os.environ.get("SNAPSHOT_HISTORY", "10"))
+_snapshot_history = OrderedDict()
+
+def build_snapshot(workbooks):
+    """Monta um novo Snapshot para estas planilhas, ou devolve o atual se nenhuma mudou."""
+    main_xl = workbooks["main"]
+    unalloc_xl = workbooks["unallocated"]
+    mov_xl = workbooks["movement"]
+
+    today = pd.Timestamp.now().normalize()
+    source_hashes = {"main": main_xl.hash, "unallocated": unalloc_xl.hash, "movement": mov_xl.hash}
+    # A data entra na versão porque os filtros de período ("hoje", "semana") dependem dela
+    version_key = "|".join([main_xl.hash, unalloc_xl.hash, mov_xl.hash, today.strftime('%Y-%m-%d')])
+    version = hashlib.sha1(version_key.encode()).hexdigest()[:16]
+
+    current = _snapshot_state["snapshot"]
+    if current is not None and current.version == version:
+        return current
+
+    print(f"DEBUG SNAPSHOT: Montando versão {version}")
+    parse_workbooks_parallel(workbooks)
+    raw_data = get_clean_data(xl=main_xl, unalloc_xl=unalloc_xl)
+    clean_data = compact_frame(raw_data)
+    memory = frame_memory_report(clean_data)
+    memory["bytes_before_compaction"] = int(raw_data.memory_usage(deep=True, index=False).sum())
+    print(f"DEBUG SNAPSHOT: clean_data {memory['bytes_before_compaction']} -> {memory['bytes']} bytes")
+    snap = Snapshot(
+        version=version,
+        built_at=time.time(),
+        source_hashes=source_hashes,
+        clean_data=clean_data,
+        movement_totals=get_movement_totals(xl=mov_xl),
+        quantity_totals=get_quantity_totals(xl=mov_xl),
+        movements={p: get_movement_data(p, xl=mov_xl, catalog=get_product_catalog(main_xl)) for p in MOVEMENT_PERIODS},
+        movement_state=get_movement_state(mov_xl),
+        workbooks={"main": main_xl, "unallocated": unalloc_xl, "movement": mov_xl},
+        memory=memory,
+    )
+    return snap
+
+def _publish_local(snap, verified_at=None):
+    """Torna `snap` o snapshot deste processo (chamar com _snapshot_lock). True se a versão é nova."""
+    previous = _snapshot_state["snapshot"]
+    if snap.version not in _snapshot_history:
+        _snapshot_history[snap.version] = snap.clean_data
+        while len(_snapshot_history) > max(SNAPSHOT_HISTORY, 1):
+            _snapshot_history.popitem(last=False)
+    _snapshot_state["snapshot"] = snap
+    _snapshot_state["verified_at"] = verified_at or time.time()
+    if snap is previous:
+        return False
+    try:
+        publish_snapshot(snap, previous)
+    except Exception as e:
+        print(f"DEBUG EVENTS: Erro ao notificar inscritos - {e}")
+    return True
+
+def install_snapshot(workbooks):
+    """Monta e publica o snapshot destas planilhas. Só uma montagem roda por vez."""
+    with _snapshot_lock:
+        snap = build_snapshot(workbooks)
+        is_new = _publish_local(snap)
+        if _shared_state["leader"]:
+            try:
+                if is_new:
+                    write_shared_snapshot(snap)
+                else:
+                    mark_shared_verified()
+            except Exception as e:
+                print(f"DEBUG SHARED: Erro ao gravar snapshot compartilhado - {e}")
+                traceback.print_exc()
+        return snap
+
+def refresh_snapshot(force_download=False):
+    """Atualização síncrona (scripts/console): baixa com requests e publica."""
+    max_age = 0 if force_download else None
+    return install_snapshot({name: get_workbook(name, max_age=max_age) for name in WORKBOOK_SOURCES})
+
+async def refresh_snapshot_async(force_download=False):
+    """Baixa as planilhas em paralelo e monta o snapshot no pool de processamento."""
+    _snapshot_state["refreshing"] = True
+    try:
+        workbooks = await fetch_workbooks(max_age=0 if force_download else None)
+        return await run_blocking(install_snapshot, workbooks)
+    finally:
+        _snapshot_state["refreshing"] = False
 
-def get_xlsx_file():
-    """Retorna a planilha de movimentação (registro de entradas/saídas)"""
-    global _xlsx_cache
-    now = time.time()
-    if _xlsx_cache["data"] and (now - (_xlsx_cache["time"] or 0) < 30):
-        return pd.ExcelFile(io.BytesIO(_xlsx_cache["data"]))
-    
-    url = "https://docs.google.com/spreadsheets/d/1_GxpusG5YZYkmqZ-DMyoRZqO4ak_6XWofqUQx2RY89s/export?format=xlsx"
-    print(f"DEBUG: Baixando XLSX de movimentação de {url}")
-    response = requests.get(url, timeout=15)
-    _xlsx_cache["data"] = response.content
-    _xlsx_cache["time"] = now
-    return pd.ExcelFile(io.BytesIO(response.content))
-
-def get_main_xlsx_file():
-    """Retorna a planilha principal com Base de dados, Posições, etc."""
-    global _main_xlsx_cache
-    now = time.time()
-    if _main_xlsx_cache["data"] and (now - (_main_xlsx_cache["time"] or 0) < 30):
-        return pd.ExcelFile(io.BytesIO(_main_xlsx_cache["data"]))
-    
-    url = EXCEL_URL
-    print(f"DEBUG: Baixando XLSX principal de {url}")
-    response = requests.get(url, timeout=15)
-    _main_xlsx_cache["data"] = response.content
-    _main_xlsx_cache["time"] = now
-    return pd.ExcelFile(io.BytesIO(response.content))
+async def _refresh_in_background():
+    try:
+        await refresh_snapshot_async(force_download=True)
+    except Exception as e:
+        print(f"DEBUG SNAPSHOT: Erro na atualização em segundo plano - {e}")
+        traceback.print_exc()
 
-@app.get("/api/stats")
-async def get_stats(period: str = "hoje"):
+async def get_snapshot():
+    """Retorna o último snapshot válido, disparando uma atualização em segundo plano se estiver velho."""
+    snap = _snapshot_state["snapshot"]
+    if snap is None and is_shared_follower():
+        # Worker seguidor: espera o que o processo atualizador gravar, sem baixar as planilhas
+        snap = await wait_for_shared_snapshot()
+    if snap is None:
+        # Primeira requisição após o boot: não há o que servir, então esperamos o processamento
+        return await refresh_snapshot_async()
+
+    # Nos seguidores quem atualiza é o _snapshot_loop, lendo o diretório compartilhado
+    if is_shared_follower():
+        return snap
+    if snapshot_age() > SNAPSHOT_REFRESH_INTERVAL and not _snapshot_state["refreshing"]:
+        _snapshot_state["refreshing"] = True
+        _snapshot_state["task"] = asyncio.create_task(_refresh_in_background())
+    return snap
+
+def snapshot_age():
+    return time.time() - _snapshot_state["verified_at"]
+
+# Snapshot compartilhado entre workers do uvicorn. Com SNAPSHOT_SHARED_DIR definido, o worker que
+# conseguir o lock do diretório vira o atualizador: baixa e processa as planilhas como sempre e
+# grava cada versão nova em SNAPSHOT_SHARED_DIR/<versão>/ (tabelas em Arrow IPC sem compressão,
+# o resto em JSON e as planilhas originais), trocando o arquivo CURRENT de forma atômica no fim.
+# Os demais workers só leem: mapeiam as tabelas em memória (sem cópia, o mesmo arquivo para todos)
+# e trocam de snapshot quando o CURRENT muda. Se o atualizador morrer, outro worker assume o lock.
+SNAPSHOT_SHARED_DIR = os.environ.get("SNAPSHOT_SHARED_DIR", "")
+SNAPSHOT_SHARED_POLL = float(os.environ.get("SNAPSHOT_SHARED_POLL", "2"))
+# Quanto um seguidor sem snapshot (boot/deploy) espera o atualizador publicar antes de responder 503
+SNAPSHOT_SHARED_WAIT = float(os.environ.get("SNAPSHOT_SHARED_WAIT", "20"))
+SHARED_SNAPSHOT_KEEP = 3
+SHARED_FRAMES = ("clean_data", "ledger", "daily_by_product")
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+_shared_state = {"leader": False, "lock_file": None, "enabled": None}
+
+def shared_snapshot_enabled():
+    if _shared_state["enabled"] is None:
+        enabled = bool(SNAPSHOT_SHARED_DIR)
+        if enabled and pa is None:
+            print("DEBUG SHARED: SNAPSHOT_SHARED_DIR definido, mas pyarrow não está instalado. Cada worker usa o próprio snapshot.")
+            enabled = False
+        if enabled:
+            os.makedirs(SNAPSHOT_SHARED_DIR, exist_ok=True)
+        _shared_state["enabled"] = enabled
+    return _shared_state["enabled"]
+
+def try_become_refresher():
+    """Tenta pegar o lock de atualizador (mantido enquanto o processo viver). True se este é o atualizador."""
+    if not shared_snapshot_enabled() or _shared_state["leader"]:
+        return _shared_state["leader"]
+    import fcntl
+    lock_file = open(os.path.join(SNAPSHOT_SHARED_DIR, "refresher.lock"), "w")
     try:
-        # Forçar hoje se vier recente (que removemos)
-        if period == "recente": period = "hoje"
-        
-        # Optimization: Fetch via existing helpers which might have some internal logic/try-except
-        # and ensure we have separate XL objects for each source
-        main_xl_content = requests.get(EXCEL_URL, timeout=30).content
-        main_xl = pd.ExcelFile(io.BytesIO(main_xl_content))
-        
-        url_mov_xlsx = MOVEMENT_GSHEET_URL.replace("format=csv", "format=xlsx")
-        mov_xl_content = requests.get(url_mov_xlsx, timeout=30).content
-        mov_xl = pd.ExcelFile(io.BytesIO(mov_xl_content))
-        
-        unalloc_xl_content = requests.get(UNALLOCATED_GSHEET_URL, timeout=30).content
-        unalloc_xl = pd.ExcelFile(io.BytesIO(unalloc_xl_content))
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _shared_state["lock_file"] = lock_file
+    _shared_state["leader"] = True
+    print(f"DEBUG SHARED: Processo {os.getpid()} é o atualizador do snapshot compartilhado.")
+    return True
+
+def is_shared_follower():
+    return shared_snapshot_enabled() and not _shared_state["leader"]
+
+def _current_path():
+    return os.path.join(SNAPSHOT_SHARED_DIR, "CURRENT")
+
+def _write_frame(df, path):
+    """Grava `df` em Arrow IPC. Colunas que o Arrow não representa (texto misturado com o 0 do
+    fillna, por exemplo) vão num pickle ao lado; devolve a ordem original das colunas."""
+    arrow_cols, other_cols = [], []
+    for col in df.columns:
+        try:
+            pa.Array.from_pandas(df[col])
+            arrow_cols.append(col)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            other_cols.append(col)
+    table = pa.Table.from_pandas(df[arrow_cols], preserve_index=True)
+    with pa.OSFile(path + ".arrow", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    if other_cols:
+        df[other_cols].to_pickle(path + ".pkl")
+    return [str(c) for c in df.columns]
+
+def _read_frame(path, columns):
+    """Mapeia o arquivo Arrow em memória e monta o DataFrame sem copiar as colunas que não precisam."""
+    table = pa.ipc.open_file(pa.memory_map(path + ".arrow", "r")).read_all()
+    df = table.to_pandas(split_blocks=True)
+    if os.path.exists(path + ".pkl"):
+        other = pd.read_pickle(path + ".pkl")
+        df = pd.concat([df, other], axis=1)
+    return df[columns]
+
+def write_shared_snapshot(snap):
+    """Grava o snapshot no diretório compartilhado e aponta o CURRENT para ele (só o atualizador)."""
+    final_dir = os.path.join(SNAPSHOT_SHARED_DIR, snap.version)
+    if not os.path.isdir(final_dir):
+        tmp_dir = os.path.join(SNAPSHOT_SHARED_DIR, f".tmp-{snap.version}-{os.getpid()}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        state = snap.movement_state
+        frames = {"clean_data": snap.clean_data, "ledger": state["ledger"], "daily_by_product": state["daily_by_product"]}
+        columns = {name: _write_frame(df, os.path.join(tmp_dir, name)) for name, df in frames.items()}
+        for name, wb in snap.workbooks.items():
+            with open(os.path.join(tmp_dir, f"{name}.xlsx"), "wb") as f:
+                f.write(wb.content)
+        meta = {
+            "version": snap.version,
+            "built_at": snap.built_at,
+            "source_hashes": snap.source_hashes,
+            "movement_totals": snap.movement_totals,
+            "quantity_totals": snap.quantity_totals,
+            "movements": snap.movements,
+            "memory": snap.memory,
+            "movement_state": {k: v for k, v in state.items() if k not in ("ledger", "daily_by_product", "daily_totals")},
+            "columns": columns,
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, default=_json_default)
+        os.rename(tmp_dir, final_dir)
+
+    tmp_current = _current_path() + f".{os.getpid()}"
+    with open(tmp_current, "w") as f:
+        f.write(snap.version)
+    os.replace(tmp_current, _current_path())
+    print(f"DEBUG SHARED: Versão {snap.version} publicada em {final_dir}")
+    _prune_shared_versions(snap.version)
+
+def mark_shared_verified():
+    """Atualizador conferiu as planilhas e nada mudou: avisa os seguidores pela data do CURRENT."""
+    if os.path.exists(_current_path()):
+        os.utime(_current_path())
+
+def _prune_shared_versions(current):
+    # Seguidores que ainda mapeiam uma versão apagada continuam lendo (o arquivo só some quando soltam)
+    versions = [d for d in os.listdir(SNAPSHOT_SHARED_DIR)
+                if os.path.isdir(os.path.join(SNAPSHOT_SHARED_DIR, d)) and not d.startswith(".")]
+    versions.sort(key=lambda d: os.path.getmtime(os.path.join(SNAPSHOT_SHARED_DIR, d)))
+    for old in [d for d in versions if d != current][:-(SHARED_SNAPSHOT_KEEP - 1) or None]:
+        shutil.rmtree(os.path.join(SNAPSHOT_SHARED_DIR, old), ignore_errors=True)
+
+def load_shared_snapshot(version):
+    """Snapshot gravado pelo atualizador, com as tabelas mapeadas do disco."""
+    base = os.path.join(SNAPSHOT_SHARED_DIR, version)
+    with open(os.path.join(base, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    frames = {name: _read_frame(os.path.join(base, name), meta["columns"][name]) for name in SHARED_FRAMES}
+    workbooks = {}
+    for name in WORKBOOK_SOURCES:
+        with open(os.path.join(base, f"{name}.xlsx"), "rb") as f:
+            workbooks[name] = Workbook(name, f.read())
+    movement_state = dict(meta["movement_state"],
+                          ledger=frames["ledger"],
+                          daily_by_product=frames["daily_by_product"],
+                          daily_totals=frames["daily_by_product"].groupby(level='dia').sum())
+    return Snapshot(
+        version=meta["version"],
+        built_at=meta["built_at"],
+        source_hashes=meta["source_hashes"],
+        clean_data=frames["clean_data"],
+        movement_totals=meta["movement_totals"],
+        quantity_totals=meta["quantity_totals"],
+        movements=meta["movements"],
+        movement_state=movement_state,
+        workbooks=workbooks,
+        memory=meta["memory"],
+    )
+
+def sync_shared_snapshot():
+    """Seguidor: troca para a versão apontada pelo CURRENT se ela mudou. Retorna o snapshot atual."""
+    try:
+        with open(_current_path()) as f:
+            version = f.read().strip()
+        verified_at = os.path.getmtime(_current_path())
+    except FileNotFoundError:
+        return _snapshot_state["snapshot"]
+    with _snapshot_lock:
+        current = _snapshot_state["snapshot"]
+        if current is not None and current.version == version:
+            _snapshot_state["verified_at"] = verified_at
+            return current
+        try:
+            snap = load_shared_snapshot(version)
+        except Exception as e:
+            print(f"DEBUG SHARED: Erro ao ler a versão {version} - {e}")
+            return current
+        _publish_local(snap, verified_at)
+        return snap
+
+async def wait_for_shared_snapshot():
+    """Seguidor ainda sem snapshot: aguarda o CURRENT do atualizador (ou assume o lock, se ninguém o tiver).
+
+    Retorna None só quando este processo virou o atualizador; 503 com Retry-After se o prazo acabar.
+    """
+    deadline = time.monotonic() + SNAPSHOT_SHARED_WAIT
+    while True:
+        snap = await run_blocking(sync_shared_snapshot)
+        if snap is not None or try_become_refresher():
+            return snap
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=503, detail="Snapshot ainda em preparação. Tente novamente em instantes.",
+                                headers={"Retry-After": str(max(int(SNAPSHOT_SHARED_POLL), 1))})
+        await asyncio.sleep(SNAPSHOT_SHARED_POLL)
+
+# EXPLICAÇÃO: as respostas de leitura só mudam quando muda o snapshot, então o ETag é a versão
+# (hashes das planilhas + data) junto com a rota e os parâmetros. Navegador e CDN podem guardar a
+# resposta por HTTP_CACHE_MAX_AGE segundos e servir a cópia velha enquanto revalidam.
+HTTP_CACHE_MAX_AGE = int(os.environ.get("HTTP_CACHE_MAX_AGE", "15"))
+HTTP_STALE_WHILE_REVALIDATE = int(os.environ.get("HTTP_STALE_WHILE_REVALIDATE", str(int(SNAPSHOT_REFRESH_INTERVAL))))
+
+def snapshot_etag(snap, request):
+    """ETag forte de uma resposta: mesma versão, rota e parâmetros geram exatamente o mesmo corpo."""
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    key = "|".join([snap.version, request.url.path, params])
+    return '"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+def set_snapshot_headers(response, snap, request=None):
+    response.headers["X-Snapshot-Version"] = snap.version
+    response.headers["X-Snapshot-Age"] = str(int(snapshot_age()))
+    if request is not None:
+        response.headers["ETag"] = snapshot_etag(snap, request)
+        response.headers["Cache-Control"] = (f"public, max-age={HTTP_CACHE_MAX_AGE}, "
+                                             f"stale-while-revalidate={HTTP_STALE_WHILE_REVALIDATE}")
+
+def not_modified(request, snap):
+    """Resposta 304 se o If-None-Match do cliente já é a versão atual; senão None."""
+    sent = request.headers.get("if-none-match")
+    if not sent:
+        return None
+    tags = [t.strip().removeprefix("W/") for t in sent.split(",")]
+    if "*" not in tags and snapshot_etag(snap, request) not in tags:
+        return None
+    response = Response(status_code=304)
+    set_snapshot_headers(response, snap, request)
+    return response
+
+async def _snapshot_loop():
+    while True:
+        if shared_snapshot_enabled() and not try_become_refresher():
+            await run_blocking(sync_shared_snapshot)
+            await asyncio.sleep(SNAPSHOT_SHARED_POLL)
+            continue
+        await _refresh_in_background()
+        await asyncio.sleep(SNAPSHOT_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+async def start_snapshot_refresher():
+    if SNAPSHOT_REFRESH_INTERVAL > 0:
+        _snapshot_state["loop_task"] = asyncio.create_task(_snapshot_loop())
+
+@app.on_event("shutdown")
+async def close_http_client():
+    client = _http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+
+def compute_divergences(df, mov_by_product):
+    """Estoque da base x saldo do registro de movimentação por produto, só onde os dois diferem.
+
+    Ordenado pela maior diferença absoluta (e pelo código do produto nos empates).
+    """
+    db_qty = pd.Series(dtype='float64')
+    if not df.empty and 'produto' in df.columns:
+        valid_db = df[df['produto'].astype(str).str.strip() != '']
+        db_qty = valid_db.groupby('produto')['quantidade_total'].sum()
+    mov_qty = pd.Series(mov_by_product, dtype='float64')
+
+    joined = pd.concat([db_qty.rename('db_qty'), mov_qty.rename('mov_qty')], axis=1, join='outer').fillna(0)
+    joined.index = joined.index.astype(str)
+    joined = joined[~joined.index.str.lower().isin(['nan', 'none', '-', ''])]
+    joined = np.trunc(joined).astype('int64')
+    joined['diff'] = joined['db_qty'] - joined['mov_qty']
+    joined = joined[joined['diff'] != 0]
+
+    result = joined.rename_axis('produto').reset_index()[['produto', 'db_qty', 'mov_qty', 'diff']]
+    result['abs_diff'] = result['diff'].abs()
+    result = result.sort_values(['abs_diff', 'produto'], ascending=[False, True], kind='stable')
+    return result.drop(columns=['abs_diff']).reset_index(drop=True)
+
+def get_divergences(snap):
+    return snap.derived("divergences", lambda s: compute_divergences(s.clean_data, s.movement_totals.get("movement_by_product", {})))
+
+def parse_date_range(start, end):
+    """Converte os parâmetros start/end (AAAA-MM-DD) em dias; 400 se vierem em outro formato."""
+    try:
+        first_day = pd.Timestamp(datetime.date.fromisoformat(start)) if start else None
+        last_day = pd.Timestamp(datetime.date.fromisoformat(end)) if end else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Use datas no formato AAAA-MM-DD em start/end.")
+    return first_day, last_day
+
+def movements_between(snap, first_day, last_day):
+    """Listagem de um intervalo personalizado, a partir do registro já ingerido do snapshot."""
+    return format_movements(snap.movement_state["ledger"], first_day, last_day, get_product_catalog(snap.workbooks["main"]))
+
+def compute_headline(snap):
+    """Indicadores gerais do /api/stats que dependem só do snapshot (não do período)."""
+    df = snap.clean_data
+    mov_totals = snap.movement_totals
+    qty_totals = snap.quantity_totals
+    # EXCLUIR POSIÇÕES BLOQUEADAS DAS CONTAGENS DE DRIVE E OCUPAÇÃO
+    stats_df = df[~df['is_blocked']] if 'is_blocked' in df.columns else df
+    return {
+        "total_pallets": int(df['paletes'].sum()),
+        "total_quantity": int(df['quantidade_total'].sum()),
+        "total_positions": int(stats_df[stats_df['posicao'] != 'S/P']['posicao'].nunique()),
+        "total_skus": qty_totals.get("total_skus", 0),
+        "avg_occupancy": float(stats_df[stats_df['capacidade'] > 0]['ocupacao'].mean()) if not stats_df[stats_df['capacidade'] > 0].empty else 0,
+        "qtd_molhado": qty_totals["qtd_molhado"],
+        "qtd_tombada": qty_totals["qtd_tombada"],
+        "movement_pieces": mov_totals["movement_pieces"],
+        "total_entries": mov_totals.get("total_entries", 0),
+        "total_exits": mov_totals.get("total_exits", 0),
+        "today_net": mov_totals.get("today_net", 0),
+        "total_capacity": int(df[df['posicao'] != 'S/P'].groupby('posicao')['capacidade'].first().sum()),
+        "unregistered_count": int(df[df['unregistered_error'] == True]['posicao'].nunique()),
+    }
 
-        # Pass specific XLs to get_clean_data
-        df = get_clean_data(xl=main_xl, unalloc_xl=unalloc_xl)
-        mov_totals = get_movement_totals(xl=mov_xl)
-        qty_totals = get_quantity_totals(xl=mov_xl)
-        
-        # CHART DATA: filtered by period
-        top_moved = get_movement_data(period, xl=mov_xl)
-        
-        # PERSISTENT MOVEMENTS: always 5 most recent
-        latest_movements = get_movement_data("recente", xl=mov_xl)[:5]
+def get_headline(snap):
+    return snap.derived("headline", compute_headline)
 
-        # CALCULATE PERIOD TOTALS (Strictly for the requested period)
-        period_entries = sum(m.get('entrada', 0) for m in top_moved)
-        period_exits = sum(m.get('saida', 0) for m in top_moved)
-        period_wet = sum(m.get('molhado', 0) for m in top_moved)
-        
-        # Calculate divergences
-        db_by_product = {}
-        if not df.empty and 'produto' in df.columns:
-            valid_db = df[df['produto'].astype(str).str.strip() != '']
-            db_groups = valid_db.groupby('produto')['quantidade_total'].sum()
-            db_by_product = db_groups.to_dict()
-            
-        mov_by_product = mov_totals.get("movement_by_product", {})
-        
-        all_products = set(db_by_product.keys()).union(set(mov_by_product.keys()))
-        divergences = []
-        for p in all_products:
-            if not p or str(p).lower() in ['nan', 'none', '-', '']: continue
-            db_qty = int(db_by_product.get(p, 0))
-            mov_qty = int(mov_by_product.get(p, 0))
-            if db_qty != mov_qty:
-                divergences.append({
-                    "produto": p,
-                    "db_qty": db_qty,
-                    "mov_qty": mov_qty,
-                    "diff": db_qty - mov_qty
-                })
-        
-        # EXCLUIR POSIÇÕES BLOQUEADAS DAS CONTAGENS DE DRIVE E OCUPAÇÃO
-        stats_df = df[~df['is_blocked']] if 'is_blocked' in df.columns else df
-        
-        return {
-            "total_pallets": int(df['paletes'].sum()),
-            "total_quantity": int(df['quantidade_total'].sum()),
-            "total_positions": int(stats_df[stats_df['posicao'] != 'S/P']['posicao'].nunique()),
-            "total_skus": qty_totals.get("total_skus", 0),
-            "avg_occupancy": float(stats_df[stats_df['capacidade'] > 0]['ocupacao'].mean()) if not stats_df[stats_df['capacidade'] > 0].empty else 0,
-            "qtd_molhado": qty_totals["qtd_molhado"],
-            "qtd_tombada": qty_totals["qtd_tombada"],
-            "movement_pieces": mov_totals["movement_pieces"],
-            "total_entries": mov_totals.get("total_entries", 0),
-            "total_exits": mov_totals.get("total_exits", 0),
-            "period_entries": int(period_entries),
-            "period_exits": int(period_exits),
-            "period_wet": int(period_wet),
-            "today_net": mov_totals.get("today_net", 0),
-            "divergences": sorted(divergences, key=lambda x: abs(x['diff']), reverse=True),
-            "total_capacity": int(df[df['posicao'] != 'S/P'].groupby('posicao')['capacidade'].first().sum()),
-            "unregistered_count": int(df[df['unregistered_error'] == True]['posicao'].nunique()),
-            "unregistered_positions": list(df[df['unregistered_error'] == True]['posicao'].unique()),
-            "top_moved": top_moved,
-            "latest_movements": latest_movements,
-            "frequency_by_product": mov_totals.get("frequency_by_product", {}),
-            "molh_frequency_by_product": mov_totals.get("molh_frequency_by_product", {})
-        }
+def _stats_period_bounds(period, first_day, last_day, custom_range):
+    return (first_day, last_day) if custom_range else period_bounds(period)
+
+def _stats_headline(snap, q):
+    return get_headline(snap)
+
+def _stats_period(snap, q):
+    # CALCULATE PERIOD TOTALS (Strictly for the requested period) from the daily rollups
+    first_day, last_day = _stats_period_bounds(q["period"], q["first_day"], q["last_day"], q["custom_range"])
+    period_totals = get_period_totals(snap.movement_state, first_day, last_day)
+    return {
+        "period_entries": int(period_totals["entrada"]),
+        "period_exits": int(period_totals["saida"]),
+        "period_wet": int(period_totals["molhado"]),
+    }
+
+def _stats_divergences(snap, q):
+    divergences = get_divergences(snap)
+    if q["min_abs_diff"] > 1:
+        divergences = divergences[divergences['diff'].abs() >= q["min_abs_diff"]]
+    if q["limit"] is not None:
+        divergences = divergences.head(q["limit"])
+    return {"divergences": divergences.to_dict(orient="records")}
+
+def _stats_unregistered(snap, q):
+    df = snap.clean_data
+    return {"unregistered_positions": list(df[df['unregistered_error'] == True]['posicao'].unique())}
+
+def _stats_movements(snap, q):
+    # CHART DATA: filtered by period
+    if q["custom_range"]:
+        top_moved = movements_between(snap, q["first_day"], q["last_day"])
+    else:
+        top_moved = period_movements(snap, q["period"])
+    # PERSISTENT MOVEMENTS: always 5 most recent
+    return {"top_moved": top_moved, "latest_movements": latest_movements(snap, 5)}
+
+def _stats_frequency(snap, q):
+    mov_totals = snap.movement_totals
+    return {
+        "frequency_by_product": mov_totals.get("frequency_by_product", {}),
+        "molh_frequency_by_product": mov_totals.get("molh_frequency_by_product", {}),
+    }
+
+def _fixed_period_key(q):
+    # Só os períodos fixos entram no cache (pelos dias que cobrem hoje); intervalos start/end vêm do cliente
+    return None if q["custom_range"] else period_bounds(q["period"])
+
+def _default_divergences_key(q):
+    return () if q["limit"] is None and q["min_abs_diff"] <= 1 else None
+
+# EXPLICAÇÃO: seções do /api/stats (parâmetro sections=) e a chave de cache de cada uma.
+# Cada seção é calculada só quando pedida. As que não dependem de parâmetros e as dos períodos fixos
+# ficam em cache no snapshot; com start/end, limit ou min_abs_diff (valores livres do cliente) a seção
+# é calculada na hora, para o cache não crescer com cada combinação pedida. Assim o painel pode buscar
+# os indicadores primeiro ("headline") e as listas pesadas depois.
+STATS_SECTIONS = {
+    "headline": (_stats_headline, lambda q: ()),
+    "period": (_stats_period, _fixed_period_key),
+    "divergences": (_stats_divergences, _default_divergences_key),
+    "unregistered": (_stats_unregistered, lambda q: ()),
+    "movements": (_stats_movements, _fixed_period_key),
+    "frequency": (_stats_frequency, lambda q: ()),
+}
+
+def parse_stats_sections(sections):
+    """Lista de seções pedidas (todas se `sections` vier vazio); 400 para nomes desconhecidos."""
+    if not sections:
+        return list(STATS_SECTIONS)
+    names = [n.strip() for n in sections.split(',') if n.strip()]
+    unknown = [n for n in names if n not in STATS_SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Seções desconhecidas: {', '.join(unknown)}. Use: {', '.join(STATS_SECTIONS)}")
+    return names
+
+def stats_payload(snap, sections, period, first_day, last_day, custom_range, limit, min_abs_diff):
+    """Corpo do /api/stats com as seções pedidas; as que têm chave de cache são calculadas uma vez por snapshot."""
+    q = {"period": period, "first_day": first_day, "last_day": last_day, "custom_range": custom_range,
+         "limit": limit, "min_abs_diff": min_abs_diff}
+    result = {}
+    for name in sections:
+        builder, cache_key = STATS_SECTIONS[name]
+        key = cache_key(q)
+        if key is None:
+            result.update(builder(snap, q))
+        else:
+            result.update(snap.derived(("stats", name) + tuple(key), lambda s, builder=builder: builder(s, q)))
+    result["snapshot_version"] = snap.version
+    return result
+
+def period_movements(snap, period):
+    """Listagem completa de um período; os que não são pré-calculados caem no registro inteiro."""
+    if period in snap.movements:
+        return snap.movements[period]
+    return snap.derived(("movements", "recente"), lambda s: format_movements(
+        s.movement_state["ledger"], catalog=get_product_catalog(s.workbooks["main"])))
+
+# Calculados a cada chamada, sem cache no snapshot: limit e o intervalo vêm livres do cliente e o
+# custo já é limitado a `limit` linhas (seleção parcial, sem ordenar o registro inteiro).
+def latest_movements(snap, limit, first_day=None, last_day=None):
+    """As `limit` movimentações mais recentes (opcionalmente dentro de um intervalo)."""
+    return format_movements(snap.movement_state["ledger"], first_day, last_day,
+                            get_product_catalog(snap.workbooks["main"]), limit=limit)
+
+def get_top_moved_products(snap, limit, first_day=None, last_day=None):
+    return top_moved_products(snap.movement_state, first_day, last_day, limit,
+                              get_product_catalog(snap.workbooks["main"]))
+
+def parse_limit(limit):
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit deve ser maior que zero")
+    return limit
+
+@app.get("/api/movimentos/recentes")
+async def get_latest_movements(request: Request, response: Response, limit: int = 5,
+                               start: Optional[str] = None, end: Optional[str] = None):
+    """As `limit` movimentações mais recentes, sem formatar o registro inteiro."""
+    parse_limit(limit)
+    first_day, last_day = parse_date_range(start, end)
+    try:
+        snap = await get_snapshot()
+        cached = not_modified(request, snap)
+        if cached is not None:
+            return cached
+        set_snapshot_headers(response, snap, request)
+        return await run_blocking(latest_movements, snap, limit, first_day, last_day)
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/confrontos")
-async def get_confrontos(type: str = "fisico_x_a501"):
+@app.get("/api/movimentos/top-produtos")
+async def get_top_products(request: Request, response: Response, period: str = "hoje", limit: int = 10,
+                           start: Optional[str] = None, end: Optional[str] = None):
+    """Os `limit` produtos mais movimentados no período (ou no intervalo start/end)."""
+    parse_limit(limit)
+    first_day, last_day = parse_date_range(start, end)
+    if not (start or end):
+        first_day, last_day = period_bounds(period)
     try:
-        # Pega a planilha de movimentação, mas exportando em xlsx para ler as abas
-        url = "https://docs.google.com/spreadsheets/d/1_GxpusG5YZYkmqZ-DMyoRZqO4ak_6XWofqUQx2RY89s/export?format=xlsx"
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        
-        xl = pd.ExcelFile(io.BytesIO(response.content))
+        snap = await get_snapshot()
+        cached = not_modified(request, snap)
+        if cached is not None:
+            return cached
+        set_snapshot_headers(response, snap, request)
+        return await run_blocking(get_top_moved_products, snap, limit, first_day, last_day)
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/stats")
+async def get_stats(request: Request, response: Response, period: str = "hoje", start: Optional[str] = None, end: Optional[str] = None,
+                    limit: Optional[int] = None, min_abs_diff: int = 1, sections: Optional[str] = None):
+    # Intervalo personalizado (AAAA-MM-DD) substitui o período
+    first_day, last_day = parse_date_range(start, end)
+    names = parse_stats_sections(sections)
+    if limit is not None:
+        parse_limit(limit)
+    if min_abs_diff < 1:
+        raise HTTPException(status_code=400, detail="min_abs_diff deve ser maior que zero")
+    try:
+        # Forçar hoje se vier recente (que removemos)
+        if period == "recente": period = "hoje"
         
-        # Lê a aba A501 (sempre necessária)
-        if "A501" in xl.sheet_names:
-            df_a501 = xl.parse("A501")
-        else:
-            df_a501 = pd.DataFrame(columns=['Produto', 'Descrição', 'Quantidade'])
-
-        # Padroniza nomes de colunas do A501
-        df_a501.columns = [str(c).strip() for c in df_a501.columns]
-        df_a501['Produto'] = df_a501['Produto'].astype(str).str.strip()
-        df_a501 = df_a501[~df_a501['Produto'].isin(['', 'nan', 'None', '-'])]
-
-        # Agrupa A501
-        a501_col = 'Quantidade' if 'Quantidade' in df_a501.columns else df_a501.columns[2]
-        df_a501[a501_col] = pd.to_numeric(df_a501[a501_col], errors='coerce').fillna(0)
-        a501_grouped = df_a501.groupby('Produto')[a501_col].sum().to_dict()
-
-        # Mapa de descrições
-        desc_map = {}
-        if 'Descrição' in df_a501.columns:
-            desc_df = df_a501.groupby('Produto')['Descrição'].first().dropna().to_dict()
-            desc_map.update(desc_df)
-
-        if type == "a501_x_g501":
-            # Lê a aba G501
-            if "G501" in xl.sheet_names:
-                df_g501 = xl.parse("G501")
-            else:
-                df_g501 = pd.DataFrame(columns=['Produto', 'Quantidade'])
-            
-            df_g501.columns = [str(c).strip() for c in df_g501.columns]
-            df_g501['Produto'] = df_g501['Produto'].astype(str).str.strip()
-            df_g501 = df_g501[~df_g501['Produto'].isin(['', 'nan', 'None', '-'])]
-            
-            g501_col = 'Quantidade' if 'Quantidade' in df_g501.columns else df_g501.columns[1]
-            df_g501[g501_col] = pd.to_numeric(df_g501[g501_col], errors='coerce').fillna(0)
-            g501_grouped = df_g501.groupby('Produto')[g501_col].sum().to_dict()
+        snap = await get_snapshot()
+        cached = not_modified(request, snap)
+        if cached is not None:
+            return cached
+        set_snapshot_headers(response, snap, request)
+        return await run_blocking(stats_payload, snap, names, period, first_day, last_day, bool(start or end), limit, min_abs_diff)
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
 
-            all_products = set(a501_grouped.keys()) | set(g501_grouped.keys())
-            
-            resultado = []
-            for p in all_products:
-                qtd_base = int(a501_grouped.get(p, 0)) # "Física" (Esquerda) -> A501 neste modo
-                qtd_target = int(g501_grouped.get(p, 0)) # "Sistema" (Direita) -> G501 neste modo
-                diff = qtd_base - qtd_target
-                
-                desc = str(desc_map.get(p, '-'))
-                if desc.lower() == 'nan': desc = '-'
-                
-                resultado.append({
-                    "produto": p,
-                    "descricao": desc,
-                    "qtd_fisica": qtd_base,   # No frontend reuso labels
-                    "qtd_sistema": qtd_target, # No frontend reuso labels
-                    "diferenca": diff
-                })
-        else:
-            # Padrão: físico_x_a501
-            if "Quantidade Total" in xl.sheet_names:
-                df_fisica = xl.parse("Quantidade Total")
-            else:
-                df_fisica = pd.DataFrame(columns=['Produto', 'Quantidade Total'])
+def _sum_by_product(xl, sheet, default_cols, qty_name, qty_pos):
+    """Lê uma aba de confronto e soma a quantidade por produto. Retorna (aba tratada, soma)."""
+    if sheet in xl.sheet_names:
+        df = xl.parse(sheet)
+    else:
+        df = pd.DataFrame(columns=default_cols)
+
+    # Padroniza nomes de colunas
+    df.columns = [str(c).strip() for c in df.columns]
+    df['Produto'] = df['Produto'].astype(str).str.strip()
+    df = df[~df['Produto'].isin(['', 'nan', 'None', '-'])]
+
+    qty_col = qty_name if qty_name in df.columns else df.columns[qty_pos]
+    qty = pd.to_numeric(df[qty_col], errors='coerce').fillna(0)
+    return df, qty.groupby(df['Produto']).sum()
+
+def _build_confronto(left, right, desc):
+    """Junta duas somas por produto (esquerda = "física", direita = "sistema") já no formato da resposta."""
+    joined = pd.concat([left.rename('qtd_fisica'), right.rename('qtd_sistema')], axis=1, join='outer').fillna(0)
+    joined = np.trunc(joined).astype('int64')
+    joined['diferenca'] = joined['qtd_fisica'] - joined['qtd_sistema']
+    joined['descricao'] = desc.reindex(joined.index)
+    joined = joined.rename_axis('produto').reset_index()
+
+    # Ordenação: divergentes primeiro, maior diferença absoluta, depois código
+    joined['_igual'] = joined['diferenca'] == 0
+    joined['_abs'] = joined['diferenca'].abs()
+    joined = joined.sort_values(['_igual', '_abs', 'produto'], ascending=[True, False, True], kind='stable')
+    return joined[['produto', 'descricao', 'qtd_fisica', 'qtd_sistema', 'diferenca']].reset_index(drop=True)
+
+def compute_confrontos(mov_xl, main_xl=None):
+    """Os dois confrontos (físico x A501 e A501 x G501) de uma versão das planilhas."""
+    df_a501, a501 = _sum_by_product(mov_xl, "A501", ['Produto', 'Descrição', 'Quantidade'], 'Quantidade', 2)
+    _, g501 = _sum_by_product(mov_xl, "G501", ['Produto', 'Quantidade'], 'Quantidade', 1)
+    _, fisica = _sum_by_product(mov_xl, "Quantidade Total", ['Produto', 'Quantidade Total'], 'Quantidade Total', 1)
+
+    # Mapa de descrições: A501 primeiro, completado pelo catálogo de produtos
+    desc = pd.Series(dtype=object)
+    if 'Descrição' in df_a501.columns:
+        desc = df_a501.groupby('Produto')['Descrição'].first().dropna().astype(str)
+        desc = desc[desc.str.lower() != 'nan']
+    catalog = get_product_catalog(main_xl)
+
+    result = {}
+    for mode, left, right in [("fisico_x_a501", fisica, a501), ("a501_x_g501", a501, g501)]:
+        df = _build_confronto(left, right, desc)
+        missing = df['descricao'].isna()
+        df['descricao'] = df['descricao'].astype(object).where(~missing, catalog.lookup_many(df['produto']))
+        result[mode] = {
+            "total_produtos": len(df),
+            "itens_com_divergencia": int((df['diferenca'] != 0).sum()),
+            "dados": df.to_dict(orient="records"),
+        }
+    return result
 
-            df_fisica.columns = [str(c).strip() for c in df_fisica.columns]
-            df_fisica['Produto'] = df_fisica['Produto'].astype(str).str.strip()
-            df_fisica = df_fisica[~df_fisica['Produto'].isin(['', 'nan', 'None', '-'])]
+def get_snapshot_confrontos(snap):
+    return snap.derived("confrontos", lambda s: compute_confrontos(s.workbooks["movement"], s.workbooks["main"]))
 
-            qt_col = 'Quantidade Total' if 'Quantidade Total' in df_fisica.columns else df_fisica.columns[1]
-            df_fisica[qt_col] = pd.to_numeric(df_fisica[qt_col], errors='coerce').fillna(0)
-            fisica_grouped = df_fisica.groupby('Produto')[qt_col].sum().to_dict()
+@app.get("/api/confrontos")
+async def get_confrontos(request: Request, response: Response, type: str = "fisico_x_a501", page: int = 1,
+                         page_size: Optional[int] = None, only_divergent: bool = False):
+    if page < 1:
+        raise HTTPException(status_code=400, detail="page deve ser maior que zero")
+    if page_size is not None and page_size < 1:
+        raise HTTPException(status_code=400, detail="page_size deve ser maior que zero")
+    try:
+        snap = await get_snapshot()
+        cached = not_modified(request, snap)
+        if cached is not None:
+            return cached
+        set_snapshot_headers(response, snap, request)
+
+        # Os dois modos são calculados juntos e ficam em cache por versão das planilhas
+        confrontos = await run_blocking(get_snapshot_confrontos, snap)
+        confronto = confrontos.get(type) or confrontos["fisico_x_a501"]
+        dados = confronto["dados"]
+        if only_divergent:
+            # Os divergentes vêm primeiro na ordenação
+            dados = dados[:confronto["itens_com_divergencia"]]
+
+        total_filtrado = len(dados)
+        if page_size:
+            dados = dados[(page - 1) * page_size:page * page_size]
 
-            all_products = set(fisica_grouped.keys()) | set(a501_grouped.keys())
-            
-            resultado = []
-            for p in all_products:
-                qtd_fisica = int(fisica_grouped.get(p, 0))
-                qtd_sistema = int(a501_grouped.get(p, 0))
-                diff = qtd_fisica - qtd_sistema
-                
-                desc = str(desc_map.get(p, '-'))
-                if desc.lower() == 'nan': desc = '-'
-                
-                resultado.append({
-                    "produto": p,
-                    "descricao": desc,
-                    "qtd_fisica": qtd_fisica,
-                    "qtd_sistema": qtd_sistema,
-                    "diferenca": diff
-                })
-
-        # Complementa descrições
-        df_desc = get_product_descriptions()
-        if not df_desc.empty and 'produto' in df_desc.columns and 'descricao' in df_desc.columns:
-            db_desc_map = df_desc.set_index('produto')['descricao'].to_dict()
-            for r in resultado:
-                if r['descricao'] == '-' and r['produto'] in db_desc_map:
-                    r['descricao'] = db_desc_map[r['produto']]
-
-        # Ordenação
-        resultado.sort(key=lambda x: (not (x["diferenca"] != 0), -abs(x["diferenca"]), x["produto"]))
-        
         return {
-            "total_produtos": len(resultado),
-            "itens_com_divergencia": len([x for x in resultado if x["diferenca"] != 0]),
-            "dados": resultado
+            "total_produtos": confronto["total_produtos"],
+            "itens_com_divergencia": confronto["itens_com_divergencia"],
+            "total_filtrado": total_filtrado,
+            "pagina": page if page_size else 1,
+            "tamanho_pagina": page_size,
+            "dados": dados
         }
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/produtos")
+async def get_produtos(request: Request, response: Response, codigos: Optional[str] = None):
+    """Descrições do catálogo para vários códigos (separados por vírgula); sem `codigos`, o catálogo inteiro."""
+    try:
+        snap = await get_snapshot()
+        cached = not_modified(request, snap)
+        if cached is not None:
+            return cached
+        set_snapshot_headers(response, snap, request)
+        catalog = await run_blocking(get_product_catalog, snap.workbooks["main"])
+        if not codigos:
+            return catalog.descriptions
+        produtos = [c.strip() for c in codigos.split(',') if c.strip()]
+        return dict(zip(produtos, catalog.lookup_many(produtos)))
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Notificação de novas versões do snapshot: em vez de cada tablet consultar o /api/stats a cada
+# intervalo, os painéis ficam inscritos (SSE em /api/events ou WebSocket em /api/ws) e recebem um
+# evento só quando uma versão nova é publicada, com os indicadores gerais que mudaram.
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", "15"))
+_subscribers = set()          # (event loop, asyncio.Queue) de cada conexão aberta
+_subscribers_lock = threading.Lock()
+
+def snapshot_event(snap, previous=None):
+    headline = get_headline(snap)
+    before = get_headline(previous) if previous is not None else {}
+    return {
+        "version": snap.version,
+        "previous": previous.version if previous is not None else None,
+        "headline": headline,
+        "changed": {k: {"de": before.get(k), "para": v} for k, v in headline.items()
+                    if previous is not None and before.get(k) != v},
+    }
+
+def _offer(queue, event):
+    # Cliente lento: só a versão mais recente interessa, então descarta o evento mais antigo
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+def publish_snapshot(snap, previous):
+    """Chamado pela thread de atualização quando uma versão nova é publicada."""
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    if not subscribers:
+        return
+    event = snapshot_event(snap, previous)
+    for loop, queue in subscribers:
+        loop.call_soon_threadsafe(_offer, queue, event)
+
+async def snapshot_events():
+    """Eventos para uma conexão: a versão atual logo de início e depois cada versão nova (None = heartbeat)."""
+    queue = asyncio.Queue(maxsize=8)
+    entry = (asyncio.get_running_loop(), queue)
+    with _subscribers_lock:
+        _subscribers.add(entry)
+    try:
+        yield await run_blocking(snapshot_event, await get_snapshot())
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield None
+    finally:
+        with _subscribers_lock:
+            _subscribers.discard(entry)
+
+@app.get("/api/events")
+async def stream_events(request: Request):
+    async def stream():
+        async for event in snapshot_events():
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ": ping\n\n"
+            else:
+                yield f"event: snapshot\nid: {event['version']}\ndata: {dumps_json(event).decode()}\n\n"
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/api/ws")
+async def websocket_events(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        async for event in snapshot_events():
+            if event is None:
+                await websocket.send_text('{"type":"ping"}')
+            else:
+                await websocket.send_text(dumps_json({"type": "snapshot", **event}).decode())
+    except WebSocketDisconnect:
+        pass
+
 class EditRequest(BaseModel):
     posicao: str
     produto: str
@@ -976,7 +2281,7 @@ class EditRequest(BaseModel):
     observacao: Optional[str] = None
 
 @app.post("/api/edit")
-async def edit_position(req: EditRequest):
+def edit_position(req: EditRequest):
     try:
         cred_path = os.path.join(os.path.dirname(__file__), "credentials.json")
         if not os.path.exists(cred_path):
@@ -1014,23 +2319,23 @@ async def edit_position(req: EditRequest):
             raise HTTPException(status_code=404, detail="Registro não encontrado na planilha.")
             
         headers = [str(h).lower().strip() for h in worksheet.row_values(1)]
+        # Mesmo mapeamento de cabeçalhos usado na leitura da aba
+        columns = ALLOCATED_SCHEMA.resolve(headers, record=False)
         updates = []
         
-        def add_update(field_keys, new_val):
+        def add_update(target, new_val):
             if new_val is not None:
-                for k in field_keys:
-                    for j, h in enumerate(headers):
-                        if k in h:
-                            cell_str = gspread.utils.rowcol_to_a1(row_index, j + 1)
-                            updates.append({'range': cell_str, 'values': [[new_val]]})
-                            return
+                col = columns.column_for(target)
+                if col is not None:
+                    cell_str = gspread.utils.rowcol_to_a1(row_index, headers.index(col) + 1)
+                    updates.append({'range': cell_str, 'values': [[new_val]]})
                             
-        add_update(['quantidade total', 'qt total'], req.quantidade_total)
-        add_update(['nivel', 'nível'], req.nivel)
-        add_update(['prof'], req.profundidade)
-        add_update(['tombada', 'tombado'], req.qtd_tombada)
-        add_update(['molhado', 'molhada'], req.qtd_molhado)
-        add_update(['obsevar', 'observacao', 'status'], req.observacao)
+        add_update('quantidade_total', req.quantidade_total)
+        add_update('nivel', req.nivel)
+        add_update('profundidade', req.profundidade)
+        add_update('qtd_tombada', req.qtd_tombada)
+        add_update('qtd_molhado', req.qtd_molhado)
+        add_update('observacao', req.observacao)
         
         if updates:
             worksheet.batch_update(updates)
@@ -1051,7 +2356,7 @@ class AddRequest(BaseModel):
     qtd_molhado: float
 
 @app.post("/api/add")
-async def add_position(req: AddRequest):
+def add_position(req: AddRequest):
     try:
         cred_path = os.path.join(os.path.dirname(__file__), "credentials.json")
         if not os.path.exists(cred_path):
@@ -1069,26 +2374,20 @@ async def add_position(req: AddRequest):
             raise HTTPException(status_code=500, detail="Erro ao acessar a planilha via gspread.")
             
         headers = [str(h).lower().strip() for h in worksheet.row_values(1)]
+        columns = ALLOCATED_SCHEMA.resolve(headers, record=False)
         
         # Montar a nova linha na ordem exata das colunas
-        new_row = [""] * len(headers)
-        
-        for j, h in enumerate(headers):
-            if 'posi' in h:
-                new_row[j] = req.posicao
-            elif 'produto' in h or 'sku' in h:
-                new_row[j] = req.produto
-            elif 'quantidade total' in h or 'qt total' in h:
-                new_row[j] = req.quantidade_total
-            elif 'nível' in h or 'nivel' in h:
-                new_row[j] = req.nivel
-            elif 'prof' in h:
-                new_row[j] = req.profundidade
-            elif 'tombada' in h or 'tombado' in h:
-                new_row[j] = req.qtd_tombada
-            elif 'molhado' in h or 'molhada' in h:
-                new_row[j] = req.qtd_molhado
-            # Deixar em branco as outras colunas (como ID Palete, que é opcional)
+        # Deixar em branco as outras colunas (como ID Palete, que é opcional)
+        values = {
+            'posicao': req.posicao,
+            'produto': req.produto,
+            'quantidade_total': req.quantidade_total,
+            'nivel': req.nivel,
+            'profundidade': req.profundidade,
+            'qtd_tombada': req.qtd_tombada,
+            'qtd_molhado': req.qtd_molhado,
+        }
+        new_row = [values.get(columns.mapping.get(h), "") for h in headers]
             
         worksheet.append_row(new_row, value_input_option="USER_ENTERED")
             
@@ -1108,7 +2407,7 @@ class AddRequest(BaseModel):
     qtd_molhado: float
 
 @app.post("/api/add")
-async def add_position(req: AddRequest):
+def add_position(req: AddRequest):
     try:
         scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
         
@@ -1142,39 +2441,34 @@ async def add_position(req: AddRequest):
         col_a_values = worksheet.col_values(1)
         next_row_idx = len(col_a_values) + 1
         
-        def get_col_letter(name_search):
-            for i, h in enumerate(headers):
-                if name_search in h:
-                    return chr(ord('A') + i) if i < 26 else None 
-            return None
+        columns = ALLOCATED_SCHEMA.resolve(headers, record=False)
+
+        def get_col_letter(target):
+            col = columns.column_for(target)
+            if col is None:
+                return None
+            i = headers.index(col)
+            return chr(ord('A') + i) if i < 26 else None
 
         # Detecção exata baseada nos cabeçalhos reais da planilha
-        col_id = get_col_letter('id palete') or 'J' # No seu print J é ID
-        col_total = get_col_letter('quantidade total') or 'G' # No seu print G é Total
-        col_qtd_palete = get_col_letter('quantidade/palete') or 'D' # No seu print D é Qtd/Palete
+        col_id = get_col_letter('id_palete') or 'J' # No seu print J é ID
+        col_total = get_col_letter('quantidade_total') or 'G' # No seu print G é Total
+        col_qtd_palete = get_col_letter('qtd_por_palete') or 'D' # No seu print D é Qtd/Palete
         
         # Montar a nova linha na ordem exata das colunas
-        new_row = [""] * len(headers)
-        
-        for j, h in enumerate(headers):
-            if 'posi' in h:
-                new_row[j] = req.posicao
-            elif 'produto' in h or 'sku' in h:
-                new_row[j] = req.produto
-            elif 'quantidade total' in h or 'qt total' in h:
-                new_row[j] = req.quantidade_total
-            elif 'nível' in h or 'nivel' in h:
-                new_row[j] = req.nivel
-            elif 'prof' in h:
-                new_row[j] = req.profundidade
-            elif 'tombada' in h or 'tombado' in h:
-                new_row[j] = req.qtd_tombada
-            elif 'molhado' in h or 'molhada' in h:
-                new_row[j] = req.qtd_molhado
-            elif 'qtd. de palete' in h or ('qtd' in h and 'palete' in h and '/' not in h):
-                # Fórmula dinâmica usando as letras de coluna reais
-                formula = f'=SE({col_id}{next_row_idx}<>""; 1/CONT.SE(${col_id}:${col_id};{col_id}{next_row_idx}); SE({col_total}{next_row_idx}=""; ""; {col_total}{next_row_idx}/{col_qtd_palete}{next_row_idx}))'
-                new_row[j] = formula
+        # Fórmula dinâmica usando as letras de coluna reais
+        formula = f'=SE({col_id}{next_row_idx}<>""; 1/CONT.SE(${col_id}:${col_id};{col_id}{next_row_idx}); SE({col_total}{next_row_idx}=""; ""; {col_total}{next_row_idx}/{col_qtd_palete}{next_row_idx}))'
+        values = {
+            'posicao': req.posicao,
+            'produto': req.produto,
+            'quantidade_total': req.quantidade_total,
+            'nivel': req.nivel,
+            'profundidade': req.profundidade,
+            'qtd_tombada': req.qtd_tombada,
+            'qtd_molhado': req.qtd_molhado,
+            'paletes': formula,
+        }
+        new_row = [values.get(columns.mapping.get(h), "") for h in headers]
                 
         worksheet.append_row(new_row, value_input_option="USER_ENTERED")
             
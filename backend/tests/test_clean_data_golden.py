@@ -0,0 +1,175 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def legacy_derive_position_columns(df):
+    """Passes row-wise de get_clean_data antes da vetorização, mantidos como referência."""
+    def clean_depth(val):
+        if pd.isna(val) or str(val).lower() == 'nan' or str(val).strip() == '':
+            return '-'
+        v_str = str(val).strip()
+        if v_str.endswith('.0'): v_str = v_str[:-2]
+        return v_str
+
+    if 'profundidade' in df.columns:
+        df['profundidade'] = df['profundidade'].apply(clean_depth)
+    else:
+        df['profundidade'] = '-'
+
+    df['id_palete'] = df['id_palete'].fillna('').astype(str).str.strip().replace('nan', '')
+    shared_mask = (df['id_palete'] != '') & (df['id_palete'] != '0') & (df['id_palete'] != 'None')
+    if shared_mask.any():
+        id_counts = df[shared_mask]['id_palete'].value_counts()
+        def balance_pallet(row):
+            if row['id_palete'] != '' and row['id_palete'] != '0' and row['id_palete'] != 'None':
+                count = id_counts.get(row['id_palete'], 1)
+                return 1.0 / count
+            return row['paletes']
+        df['paletes'] = df.apply(balance_pallet, axis=1)
+
+    for col in ['qtd_tombada', 'qtd_molhado']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        else:
+            df[col] = 0.0
+
+    if 'is_unallocated_source' not in df.columns:
+        df['is_unallocated_source'] = False
+    df['is_unallocated_source'] = df['is_unallocated_source'].fillna(False).astype(bool)
+
+    def check_damage_flag(row):
+        text = (str(row.get('produto', '')) + " " + str(row.get('observacao', ''))).lower()
+        is_molhado = 1 if 'molhad' in text or row.get('qtd_molhado', 0) > 0 else 0
+        is_tombado = 1 if 'tombad' in text or row.get('qtd_tombada', 0) > 0 else 0
+        return pd.Series([is_molhado, is_tombado], index=['is_molhado', 'is_tombado'])
+
+    df[['is_molhado', 'is_tombado']] = df.apply(check_damage_flag, axis=1)
+
+    def calculate_occupancy(row):
+        if row.get('is_unallocated_source', False):
+            return 0.0
+        cap = row.get('capacidade', 0)
+        pal = row.get('paletes', 0)
+        if cap > 0:
+            return (pal / cap) * 100
+        return 0.0
+
+    df['ocupacao'] = df.apply(calculate_occupancy, axis=1)
+    return df
+
+
+def assert_same_values(expected, actual):
+    assert list(expected.columns) == list(actual.columns)
+    for col in expected.columns:
+        exp, act = expected[col].tolist(), actual[col].tolist()
+        if pd.api.types.is_numeric_dtype(expected[col]) or pd.api.types.is_numeric_dtype(actual[col]):
+            np.testing.assert_allclose(np.asarray(exp, dtype=float), np.asarray(act, dtype=float), err_msg=col)
+        else:
+            assert exp == act, col
+
+
+def position_frame(paletes):
+    n = len(paletes)
+    return pd.DataFrame({
+        'produto': ['1001-01', '1002-02 molhado', '1003-03', 'Tombado 1004', '1005-05', '1006-06'][:n],
+        'observacao': ['ok', None, 'Molhada no canto', 'N/A', 'tombada', 'avaria'][:n],
+        'profundidade': [1.0, '2', None, ' 3.0 ', 'nan', ''][:n],
+        'id_palete': ['P1', 'P1', None, '0', 'P2', 'nan'][:n],
+        'paletes': paletes,
+        'capacidade': [4, 4, 0, 3, 6, 2][:n],
+        'qtd_tombada': [0, 0, 2, None, 0, 'x'][:n],
+        'qtd_molhado': [0, 1, 0, 0, None, 0][:n],
+        'is_unallocated_source': [False, False, False, True, None, False][:n],
+    })
+
+
+@pytest.mark.parametrize('paletes', [
+    pd.Series([1, 2, 1, 3, 2, 1], dtype='int64'),
+    pd.Series([1.0, 0.5, np.nan, 2.0, 1.0, 0.0], dtype='float64'),
+])
+def test_position_columns_match_row_wise(paletes):
+    expected = legacy_derive_position_columns(position_frame(paletes))
+    actual = main.derive_position_columns(position_frame(paletes))
+    assert_same_values(expected, actual)
+    assert actual['paletes'].tolist()[:2] == [0.5, 0.5]
+
+
+def workbook(name, sheets):
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf) as w:
+        for sheet, df in sheets.items():
+            df.to_excel(w, sheet_name=sheet, index=False)
+    return main.Workbook(name, buf.getvalue())
+
+
+def drive_workbooks():
+    """Leiaute da planilha real: todas as posições cadastradas e 'Qtd. de Palete' só com inteiros."""
+    positions = ['A01-1', 'A01-2', 'A02-1', 'A02-2', 'B01-1']
+    main_xl = workbook('main', {
+        'Base de dados': pd.DataFrame({
+            'Posição atual': ['A01-1', 'A01-1', 'A01-2', 'A02-1', 'A02-2', 'B01-1', 'B01-1'],
+            'Capacidade': [4, 4, 3, 3, 3, 2, 2],
+            'Produto': ['1001-01', '1002-02', '1001-01 molhado', '1003-03', '1003-03', '1004-04', '1005-05'],
+            'Quantidade/palete': [10, 20, 10, 5, 5, 8, 8],
+            'Nivel': [1, 1, 2, 1, 2, 1, 1],
+            'Profundidade': [1, 1, 2, 1, 2, 3, 3],
+            'Quantidade Total': [10, 20, 10, 15, 5, 8, 8],
+            'ID Palete': ['P1', 'P1', None, None, None, 'P7', 'P7'],
+            'Qtd. de Palete': [1, 1, 1, 3, 1, 1, 1],
+            'Parte Tombada': [0, 0, 0, 2, 0, 0, 0],
+            'Parte Molhada': [0, 0, 3, 0, 0, 0, 0],
+            'Obsevarção': [None, 'tombado', None, None, None, None, 'ok'],
+        }),
+        'Posições Cadastradas': pd.DataFrame({
+            'Posição': positions,
+            'Capacidade': [4, 3, 3, 3, 2],
+            'Status': ['Aberto', 'Aberto', 'Aberto', 'Fechado', 'Aberto'],
+            'Nível': [1, 2, 1, 2, 1],
+            'Profundidade': [1, 2, 1, 2, 3],
+            'Observação': [None] * len(positions),
+        }),
+        'Inf dos produtos': pd.DataFrame({
+            'Código': ['1001-01', '1002-02', '1003-03'],
+            'Descrição': ['Caixa', 'Fardo', 'Saco'],
+        }),
+    })
+    unalloc_xl = workbook('unallocated', {
+        'Sheet1': pd.DataFrame({
+            'Produto': ['1002-02', '1003-03'],
+            'Quantidade no palete': [10, 10],
+            'Qtd. de palete': [1, 2],
+            'Quantidade total': [10, 20],
+            'ID palete': ['U1', None],
+            'Parte Tombada': [0, 0],
+            'Parte Molhada': [0, 1],
+            'Observação': [None, 'molhado'],
+        }),
+    })
+    return main_xl, unalloc_xl
+
+
+def clean_data(monkeypatch):
+    main_xl, unalloc_xl = drive_workbooks()
+    # Quem chamar get_workbook('main') recebe esta mesma planilha, sem baixar nada
+    monkeypatch.setitem(main._workbooks, 'main', main_xl)
+    return main.get_clean_data(xl=main_xl, unalloc_xl=unalloc_xl)
+
+
+def test_clean_data_matches_row_wise_on_integer_pallets(monkeypatch):
+    actual = clean_data(monkeypatch)
+
+    monkeypatch.setattr(main, 'derive_position_columns', legacy_derive_position_columns)
+    expected = clean_data(monkeypatch)
+
+    assert_same_values(expected, actual)
+    shared = actual[actual['id_palete'].isin(['P1', 'P7'])]
+    assert shared['paletes'].tolist() == [0.5, 0.5, 0.5, 0.5]
@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def frame_with_dates():
+    """Como sai do get_clean_data quando a 'Base de dados' tem uma coluna formatada como data."""
+    return pd.DataFrame({
+        'posicao': ['A01-1', 'A01-2'],
+        'produto': ['1001-01', '1002-02'],
+        'id_palete': ['', 'P1'],
+        'data_alteracao': pd.to_datetime(['2024-03-05 00:00', '2024-03-06 14:30']),
+        'extra': pd.Series([pd.Timestamp('2024-01-02'), np.int64(7)], dtype=object),
+        'paletes': [1.0, 0.5],
+    })
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def serializer(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(main, 'orjson', None)
+    elif main.orjson is None:
+        pytest.skip('orjson não instalado')
+
+
+def test_records_and_columnar_serialize_dates(serializer):
+    records = json.loads(main.serialize_data(frame_with_dates(), 'records'))
+    assert records[0]['data_alteracao'] == '2024-03-05T00:00:00'
+    assert records[1]['data_alteracao'] == '2024-03-06T14:30:00'
+    assert [r['extra'] for r in records] == ['2024-01-02T00:00:00', 7]
+
+    columnar = json.loads(main.serialize_data(frame_with_dates(), 'columnar'))
+    assert columnar['data_alteracao'] == ['2024-03-05T00:00:00', '2024-03-06T14:30:00']
+    assert columnar['paletes'] == [1.0, 0.5]
+
+
+def test_changes_serialize_dates(serializer):
+    old = frame_with_dates()
+    new = frame_with_dates()
+    new.loc[1, 'data_alteracao'] = pd.Timestamp('2024-04-01')
+    changes = json.loads(main.dumps_json(main.compute_changes(old, new)))
+    assert [r['data_alteracao'] for r in changes['modified']] == ['2024-04-01T00:00:00']
@@ -0,0 +1,92 @@
+import io
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def register(rows=120):
+    today = pd.Timestamp.now().normalize()
+    return pd.DataFrame({
+        'Data': [(today - pd.Timedelta(days=i % 9)).strftime('%d/%m/%Y') for i in range(rows)],
+        'Produto': [f'100{i % 7}-0{i % 3}' for i in range(rows)],
+        'Entrada': [i % 5 for i in range(rows)],
+        'Saída': [i % 3 for i in range(rows)],
+        'Origem': ['Mapeamento' if i % 11 == 0 else 'Doca' for i in range(rows)],
+        'Molhado': [1 if i % 13 == 0 else 0 for i in range(rows)],
+    })
+
+
+def workbook(df):
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf) as w:
+        df.to_excel(w, sheet_name='Registro', index=False)
+    return main.Workbook('movement', buf.getvalue())
+
+
+@pytest.fixture
+def typed_rows(monkeypatch):
+    """Quantas linhas cada ingestão converteu: só as novas no caminho incremental, todas numa reconstrução."""
+    counts = []
+    original = main._type_movement_rows
+
+    def spy(df, today):
+        counts.append(len(df))
+        return original(df, today)
+
+    monkeypatch.setattr(main, '_type_movement_rows', spy)
+    return counts
+
+
+def assert_same_state(actual, expected):
+    for key in ('totals', 'movement_by_product', 'frequency_by_product', 'molh_frequency_by_product'):
+        assert actual[key] == pytest.approx(expected[key]), key
+    assert actual['today_net'] == pytest.approx(expected['today_net'])
+    pd.testing.assert_frame_equal(actual['ledger'], expected['ledger'])
+    pd.testing.assert_frame_equal(actual['daily_by_product'], expected['daily_by_product'])
+
+
+def ingest_twice(first, second):
+    acc = main.MovementAccumulator()
+    acc.ingest(workbook(first))
+    return acc.ingest(workbook(second))
+
+
+def test_append_only_matches_fresh_ingest(typed_rows):
+    base = register()
+    grown = pd.concat([base, register(135).iloc[120:]], ignore_index=True)
+
+    state = ingest_twice(base, grown)
+    assert typed_rows == [120, 15]
+    assert_same_state(state, main.MovementAccumulator().ingest(workbook(grown)))
+
+
+def test_edited_earlier_row_forces_rebuild(typed_rows):
+    base = register()
+    edited = pd.concat([base, register(121).iloc[120:]], ignore_index=True)
+    # Bem acima das últimas linhas já processadas
+    edited.loc[10, 'Saída'] = 10000
+
+    state = ingest_twice(base, edited)
+    assert typed_rows == [120, 121]
+    fresh = main.MovementAccumulator().ingest(workbook(edited))
+    assert_same_state(state, fresh)
+    assert state['totals']['saida'] == base['Saída'].sum() - base.loc[10, 'Saída'] + 10000 + edited.loc[120, 'Saída']
+
+
+def test_dtype_drift_in_appended_rows_stays_incremental(typed_rows):
+    base = register()
+    appended = register(122).iloc[120:].astype(object)
+    # Célula vazia vira a coluna int em float ("5" -> "5.0"); texto com vírgula a deixa como object
+    appended.iloc[0, appended.columns.get_loc('Saída')] = None
+    appended.iloc[1, appended.columns.get_loc('Entrada')] = '3,5'
+    grown = pd.concat([base, appended], ignore_index=True)
+
+    state = ingest_twice(base, grown)
+    assert typed_rows == [120, 2]
+    assert_same_state(state, main.MovementAccumulator().ingest(workbook(grown)))
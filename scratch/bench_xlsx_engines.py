@@ -0,0 +1,68 @@
+"""
+Compara o tempo de leitura das planilhas com cada leitor XLSX suportado pelo backend
+(openpyxl e calamine), usando backend/data/Drive atualizado.xlsx e cópias sintéticas
+ampliadas dele.
+
+Uso: python scratch/bench_xlsx_engines.py [fator1 fator2 ...]
+"""
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, "backend", "data", "Drive atualizado.xlsx")
+REPEAT = 3
+
+
+def available_engines():
+    engines = ["openpyxl"]
+    try:
+        import python_calamine  # noqa: F401
+        engines.append("calamine")
+    except ImportError:
+        print("python-calamine não instalado: comparando só openpyxl.")
+    return engines
+
+
+def scaled_copy(sheets, factor):
+    """Repete as linhas de cada aba `factor` vezes e grava um novo XLSX em memória."""
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+        for name, df in sheets.items():
+            pd.concat([df] * factor, ignore_index=True).to_excel(writer, sheet_name=name, index=False)
+    return buf.getvalue()
+
+
+def time_parse(content, engine):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        xl = pd.ExcelFile(io.BytesIO(content), engine=engine)
+        for s in xl.sheet_names:
+            xl.parse(s)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    factors = [int(f) for f in sys.argv[1:]] or [1, 10, 50]
+    with open(SOURCE, "rb") as f:
+        original = f.read()
+    sheets = pd.read_excel(io.BytesIO(original), sheet_name=None)
+    engines = available_engines()
+
+    print(f"{'fator':>6} {'linhas':>8} {'MB':>6} " + " ".join(f"{e:>10}" for e in engines) + "  ganho")
+    for factor in factors:
+        content = original if factor == 1 else scaled_copy(sheets, factor)
+        rows = sum(len(df) for df in sheets.values()) * factor
+        times = [time_parse(content, e) for e in engines]
+        gain = f"{times[0] / times[-1]:.1f}x" if len(times) > 1 else "-"
+        cols = " ".join(f"{t:>9.3f}s" for t in times)
+        print(f"{factor:>6} {rows:>8} {len(content) / 1e6:>6.2f} {cols}  {gain}")
+
+
+if __name__ == "__main__":
+    main()